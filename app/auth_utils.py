@@ -1,3 +1,7 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import jwt
@@ -6,14 +10,24 @@ from jose import jwt
 SECRET_KEY = "day_la_khoa_bi_mat_sieu_cuc_ky_bao_mat_cua_cau_nha"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+PBKDF2_ROUNDS = int(os.environ.get("COVAY_PBKDF2_ROUNDS", 29000)) # Đổi số vòng: hash cũ được băm lại khi user đăng nhập
+HASH_WORKERS = int(os.environ.get("COVAY_HASH_WORKERS", 2)) # Số luồng băm mật khẩu (pbkdf2 nhả GIL)
+HASH_MAX_PENDING = int(os.environ.get("COVAY_HASH_MAX_PENDING", 32)) # Đang chạy + xếp hàng, quá thì từ chối ngay
+HASH_PER_USER = int(os.environ.get("COVAY_HASH_PER_USER", 1))
+HASH_PER_IP = int(os.environ.get("COVAY_HASH_PER_IP", 4))
 
 # --- SỬA DÒNG DƯỚI ĐÂY ---
 # Đổi từ ["bcrypt"] sang ["pbkdf2_sha256"] để tránh lỗi trên Windows
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto",
+                           pbkdf2_sha256__rounds=PBKDF2_ROUNDS, pbkdf2_sha256__min_rounds=PBKDF2_ROUNDS)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update(plain_password, hashed_password):
+    """(đúng mật khẩu?, hash mới nếu hash cũ dùng tham số lỗi thời / None)."""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def get_password_hash(password):
     return pwd_context.hash(password)
 
@@ -22,4 +36,81 @@ def create_access_token(data: dict):
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
\ No newline at end of file
+    return encoded_jwt
+
+class HashBusy(Exception):
+    """Pool băm mật khẩu đã đầy."""
+
+class HashThrottled(Exception):
+    """User / IP này đang có quá nhiều lượt băm cùng lúc."""
+
+class HashPool:
+    """
+    Băm / kiểm tra mật khẩu trên vài luồng riêng, không dùng chung threadpool với request game.
+    Giới hạn tổng số lượt (chạy + xếp hàng) và số lượt đồng thời mỗi user / IP; vượt thì từ chối ngay.
+    Chỉ gọi từ event loop (đếm không cần khóa).
+    """
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING, per_user=HASH_PER_USER, per_ip=HASH_PER_IP):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="pwhash")
+        self.workers = workers
+        self.max_pending = max_pending
+        self.per_user = per_user
+        self.per_ip = per_ip
+        self.by_user = {}
+        self.by_ip = {}
+        self.stats = {"pending": 0, "max_pending_seen": 0, "done": 0, "rejected_busy": 0, "rejected_user": 0,
+                      "rejected_ip": 0, "rehashed": 0, "total_wait": 0.0, "total_time": 0.0}
+
+    async def run(self, fn, *args, user=None, ip=None):
+        """Chạy fn(*args) trên pool. Ném HashBusy / HashThrottled thay vì xếp hàng dài."""
+        s = self.stats
+        if s["pending"] >= self.max_pending:
+            s["rejected_busy"] += 1; raise HashBusy()
+        if user is not None and self.by_user.get(user, 0) >= self.per_user:
+            s["rejected_user"] += 1; raise HashThrottled()
+        if ip is not None and self.by_ip.get(ip, 0) >= self.per_ip:
+            s["rejected_ip"] += 1; raise HashThrottled()
+        self._inc(self.by_user, user, 1); self._inc(self.by_ip, ip, 1)
+        s["pending"] += 1; s["max_pending_seen"] = max(s["max_pending_seen"], s["pending"])
+        queued = time.perf_counter(); started = []
+        def call():
+            started.append(time.perf_counter())
+            return fn(*args)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        finally:
+            end = time.perf_counter()
+            s["pending"] -= 1; s["done"] += 1
+            if started: s["total_wait"] += started[0] - queued; s["total_time"] += end - started[0]
+            self._inc(self.by_user, user, -1); self._inc(self.by_ip, ip, -1)
+
+    @staticmethod
+    def _inc(counts, key, d):
+        if key is None: return
+        n = counts.get(key, 0) + d
+        if n > 0: counts[key] = n
+        else: counts.pop(key, None)
+
+    async def hash(self, password, user=None, ip=None):
+        return await self.run(get_password_hash, password, user=user, ip=ip)
+
+    async def verify(self, password, hashed, user=None, ip=None):
+        """(đúng?, hash mới cần lưu hoặc None) — hash mới khi PBKDF2_ROUNDS đã đổi."""
+        ok, new_hash = await self.run(verify_and_update, password, hashed, user=user, ip=ip)
+        if new_hash is not None: self.stats["rehashed"] += 1
+        return ok, new_hash
+
+    def snapshot_stats(self):
+        s = dict(self.stats)
+        done = max(1, s["done"])
+        s["avg_wait_ms"] = round(1000 * s.pop("total_wait") / done, 2)
+        s["avg_hash_ms"] = round(1000 * s.pop("total_time") / done, 2)
+        s["queued"] = max(0, s["pending"] - self.workers)
+        s["workers"] = self.workers; s["max_pending"] = self.max_pending
+        return s
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+hash_pool = HashPool()
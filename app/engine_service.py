@@ -0,0 +1,379 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from app.game_logic.board import GoBoard
+from app.game_logic.ai import get_engine, level_time_limit
+from app.game_logic.mcts import MCTSSearch, merge_root_stats, best_from_stats
+from app.game_logic.book import BOOK_SIZES, get_book
+
+# --- CẤU HÌNH ---
+# Số process tính AI và số job được phép xếp hàng thêm (quá thì từ chối ngay)
+ENGINE_WORKERS = int(os.environ.get("COVAY_ENGINE_WORKERS", os.cpu_count() or 2))
+ENGINE_MAX_QUEUE = int(os.environ.get("COVAY_ENGINE_MAX_QUEUE", ENGINE_WORKERS * 4))
+DEADLINE_GRACE = 1.0 # Giây chờ thêm sau deadline trước khi coi job là treo
+POLL_INTERVAL = 0.25 # Chu kỳ kiểm tra client còn kết nối
+WARMUP_TIMEOUT = 60 # Giây tối đa start() chờ dựng xong worker
+# Số process chạy song song cho 1 lượt MCTS (root parallel), mặc định = số worker
+MCTS_PARALLEL = int(os.environ.get("COVAY_MCTS_PARALLEL", ENGINE_WORKERS))
+RESULT_CACHE_SIZE = int(os.environ.get("COVAY_ENGINE_CACHE", 4096)) # Số kết quả tìm nước được nhớ (LRU)
+# Ponder: sau khi AI đi, dùng worker rảnh tính trước gợi ý cho người + nước đáp cho nước người dễ đi nhất
+PONDER = os.environ.get("COVAY_PONDER", "0") == "1"
+HINT_LEVEL = 'hard'
+
+class EngineBusy(Exception):
+    """Hàng đợi engine đã đầy."""
+
+class EngineCancelled(Exception):
+    """Job bị hủy (client ngắt kết nối, undo...)."""
+
+# --- PHẦN CHẠY TRONG WORKER PROCESS ---
+_cancel_flags = None
+
+def _init_worker(flags):
+    global _cancel_flags
+    _cancel_flags = flags
+
+def _search_job(pos, player, level, deadline, slot):
+    """Tìm nước đi cho 1 thế cờ đã serialize. Chạy trong process con."""
+    if _cancel_flags[slot] or time.time() >= deadline:
+        return {"move": None, "depth": 0, "score": None, "nodes": 0, "aborted": True}
+    board = GoBoard.from_position(pos)
+    # Engine dùng lại trong worker: chỉ đặt lại giờ và hàm hủy cho job này
+    ai = get_engine(board.size, level, player)
+    ai.time_limit = min(level_time_limit(level), deadline - time.time())
+    ai.should_stop = lambda: _cancel_flags[slot] == 1
+    move = ai.get_best_move(board, player)
+    return {"move": move, "depth": ai.last_depth, "score": ai.last_score, "nodes": ai.nodes,
+            "aborted": _cancel_flags[slot] == 1}
+
+def _mcts_job(pos, player, deadline, slot, seed):
+    """1 nhánh root-parallel của MCTS: trả về thống kê gốc để server gộp."""
+    if _cancel_flags[slot] or time.time() >= deadline:
+        return {"stats": {}, "playouts": 0}
+    board = GoBoard.from_position(pos)
+    search = MCTSSearch(board.size, seed)
+    search.should_stop = lambda: _cancel_flags[slot] == 1
+    stats = search.search(board, player, deadline - time.time())
+    return {"stats": stats, "playouts": search.playouts}
+
+def _combine_mcts(results):
+    stats = merge_root_stats(r["stats"] for r in results)
+    move, winrate = best_from_stats(stats)
+    playouts = sum(r["playouts"] for r in results)
+    print(f"🔥 AI Move (MCTS x{len(results)}): {move} | Winrate: {winrate:.2f} | Playouts: {playouts}")
+    return {"move": move, "depth": 0, "score": winrate, "nodes": playouts, "aborted": False}
+
+def _analyze_job(pos, player, played, level, deadline, slot):
+    """Phân tích 1 nước của ván: nước tốt nhất của engine và điểm của nước đã đi (cùng độ sâu)."""
+    if _cancel_flags[slot] or time.time() >= deadline:
+        return {"best": None, "best_score": None, "move_score": None, "depth": 0, "aborted": True}
+    board = GoBoard.from_position(pos)
+    ai = get_engine(board.size, level, player)
+    ai.should_stop = lambda: _cancel_flags[slot] == 1
+    # Chừa ~30% thời gian để chấm nước đã đi
+    ai.time_limit = (deadline - time.time()) * 0.7
+    best = ai.get_best_move(board, player)
+    res = {"best": best, "best_score": ai.last_score, "move_score": None, "depth": ai.last_depth,
+           "aborted": _cancel_flags[slot] == 1}
+    if played == best: res["move_score"] = ai.last_score
+    elif ai.last_depth:
+        res["move_score"] = ai.evaluate_move(board, player, played, ai.last_depth, deadline - time.time())
+    return res
+
+def _warmup():
+    # mmap sẵn sách khai cuộc trong worker
+    for size in BOOK_SIZES: get_book(size)
+    return os.getpid()
+
+# --- PHẦN CHẠY TRONG SERVER ---
+class EngineJob:
+    """
+    Handle của 1 job tìm nước: await result(), hoặc cancel().
+    1 job có thể gồm nhiều job con (MCTS root parallel), mỗi job con giữ 1 slot.
+    """
+
+    def __init__(self, service, gid, slots, cfutures, deadline, combine=None, key=None, ponder=False):
+        self.service = service
+        self.executor = service.executor # Pool chạy job này (để biết pool nào hỏng)
+        self.gid = gid
+        self.key = key # Khóa cache của thế cờ đang tính
+        self.ponder = ponder # Job tính trước, không có client nào chờ (search() dùng chung thì bỏ cờ)
+        self.slots = slots
+        self.cfutures = cfutures
+        # return_exceptions: chờ đủ mọi job con rồi mới trả slot
+        self.future = asyncio.gather(*(asyncio.wrap_future(f) for f in cfutures), return_exceptions=True)
+        self.combine = combine
+        self.deadline = deadline
+        self.submitted_at = time.time()
+        self.cancelled = False
+        self._value = None
+
+    def cancel(self):
+        if self.future.done(): return
+        self.cancelled = True
+        # Job đang chạy: báo worker dừng ở nút kế tiếp. Job còn trong hàng đợi: bỏ luôn.
+        for slot in self.slots: self.service.cancel_flags[slot] = 1
+        for cfuture in self.cfutures: cfuture.cancel()
+
+    def error(self):
+        for res in self.future.result():
+            if isinstance(res, BaseException): return res
+        return None
+
+    async def result(self, is_disconnected=None):
+        """Chờ kết quả; tự hủy khi quá deadline hoặc khi is_disconnected() trả True."""
+        while not self.future.done():
+            remaining = self.deadline + DEADLINE_GRACE - time.time()
+            if remaining <= 0:
+                self.cancel(); self.service.stats["timed_out"] += 1
+                raise asyncio.TimeoutError()
+            await asyncio.wait({self.future}, timeout=min(POLL_INTERVAL, remaining))
+            if not self.future.done() and is_disconnected is not None and await is_disconnected():
+                self.cancel()
+        if self.cancelled: raise EngineCancelled()
+        err = self.error()
+        if isinstance(err, asyncio.CancelledError): raise EngineCancelled()
+        if err is not None: raise err
+        return self.value()
+
+    def value(self):
+        """Kết quả đã gộp (chỉ gọi khi future xong mà không lỗi)."""
+        if self._value is None:
+            results = self.future.result()
+            self._value = self.combine(results) if self.combine else results[0]
+        return self._value
+
+class EngineService:
+    """
+    Chạy AI trong process pool, ngoài request path và ngoài GIL của server.
+    Giới hạn số job đồng thời (chạy + xếp hàng), từ chối nhanh khi đầy, đếm metrics.
+    """
+
+    def __init__(self, workers=ENGINE_WORKERS, max_queue=ENGINE_MAX_QUEUE):
+        self.workers = workers
+        self.max_in_flight = workers + max_queue
+        self.executor = None
+        self.warmups = [] # Future dựng sẵn worker của pool hiện tại
+        self.spawn_time = 2.0 # Giây dựng xong pool (đo lúc start), dùng khi pool phải dựng lại
+        self.ready_at = 0.0 # Lúc pool hiện tại dự kiến sẵn sàng
+        self.cancel_flags = None
+        self.free_slots = []
+        self.jobs_by_game = {}
+        self.cache = OrderedDict() # khóa thế cờ -> kết quả, cũ nhất ở đầu
+        self.pending = {} # khóa thế cờ -> job đang tính
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0,
+                      "cancelled": 0, "timed_out": 0, "in_flight": 0, "peak_in_flight": 0,
+                      "total_latency": 0.0, "cache_hits": 0, "shared_hits": 0, "pondered": 0}
+
+    def start(self):
+        """
+        Dựng pool và chờ mọi worker sẵn sàng (spawn + import mất cả giây) rồi mới nhận job, để thời gian
+        dựng worker không bị trừ vào deadline của job đầu tiên. Chặn luồng gọi: main.py chạy trong threadpool.
+        """
+        # spawn: an toàn khi server đang có thread, và chạy được cả trên Windows
+        ctx = multiprocessing.get_context("spawn")
+        # Mỗi slot 1 cờ hủy, chia sẻ với mọi worker
+        self.cancel_flags = ctx.Array('b', self.max_in_flight, lock=False)
+        self.free_slots = list(range(self.max_in_flight))
+        started = time.time()
+        self.executor = self._new_executor()
+        wait(self.warmups, timeout=WARMUP_TIMEOUT)
+        self.spawn_time = time.time() - started; self.ready_at = time.time()
+
+    def _new_executor(self):
+        executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_worker, initargs=(self.cancel_flags,))
+        # Dựng sẵn worker: mỗi worker nhận 1 job _warmup
+        self.warmups = [executor.submit(_warmup) for _ in range(self.workers)]
+        self.ready_at = time.time() + self.spawn_time
+        return executor
+
+    def _deadline(self, time_budget):
+        if self.executor is None: self.start() # Gọi ngoài server (tool, script): dựng pool trước khi tính giờ
+        # Pool vừa dựng lại sau khi worker chết: tính giờ từ lúc worker dự kiến sẵn sàng
+        return max(time.time(), self.ready_at) + time_budget
+
+    def shutdown(self):
+        if self.executor is not None:
+            # Báo mọi job đang chạy dừng sớm rồi mới chờ worker thoát
+            for slot in range(self.max_in_flight): self.cancel_flags[slot] = 1
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    @staticmethod
+    def cache_key(board, player, level):
+        # Vị trí + bên đi + level (khác level thì độ sâu / độ ngẫu nhiên khác)
+        return (board.size, board.hash, player, level)
+
+    def _cache_put(self, key, res):
+        self.cache[key] = res; self.cache.move_to_end(key)
+        while len(self.cache) > RESULT_CACHE_SIZE: self.cache.popitem(last=False)
+
+    async def search(self, gid, board, player, level, is_disconnected=None):
+        """
+        Tìm nước cho thế cờ: lấy từ cache nếu có, dùng chung job đang tính đúng thế cờ này
+        (vd: job ponder), không thì gửi job mới. Ném EngineBusy / EngineCancelled / TimeoutError.
+        """
+        key = self.cache_key(board, player, level)
+        res = self.cache.get(key)
+        if res is not None:
+            self.cache.move_to_end(key); self.stats["cache_hits"] += 1
+            return res
+        # Ponder đoán sai nhánh: trả worker cho job thật
+        for job in list(self.jobs_by_game.get(gid, ())):
+            if job.ponder and job.key != key: job.cancel()
+        job = self.pending.get(key)
+        if job is not None and not job.cancelled:
+            # Đã có client chờ: hết là job ponder, _preempt_ponder / đoán sai nhánh không được hủy nữa
+            job.ponder = False; self.stats["shared_hits"] += 1
+        else: job = self.submit(gid, board, player, level)
+        return await job.result(is_disconnected)
+
+    def ponder(self, gid, board, human, ai_level):
+        """
+        Sau nước của AI: nếu còn worker rảnh thì tính trước gợi ý cho người (HINT_LEVEL),
+        xong thì tính luôn nước đáp của AI cho nước người nhiều khả năng đi nhất.
+        """
+        if not PONDER or board.is_game_over: return
+        snap = board.copy()
+
+        def follow_up(job):
+            if job.cancelled or job.error() is not None: return
+            move = job.value()["move"]
+            if move is None: return
+            child = snap.copy()
+            if child.make_move(move[0], move[1], human)[0]:
+                self._submit_ponder(gid, child, child.current_turn, ai_level)
+
+        job = self._submit_ponder(gid, snap, human, HINT_LEVEL)
+        if job is not None: job.future.add_done_callback(lambda _: follow_up(job))
+
+    def _submit_ponder(self, gid, board, player, level):
+        key = self.cache_key(board, player, level)
+        # Chỉ dùng worker đang rảnh, không chiếm chỗ trong hàng đợi của job thật
+        if key in self.cache or key in self.pending or self.stats["in_flight"] >= self.workers: return None
+        self.stats["pondered"] += 1
+        return self.submit(gid, board, player, level, ponder=True)
+
+    def _preempt_ponder(self):
+        """Job thật tới khi worker đã đầy: hủy 1 job ponder (chưa có ai chờ) để nhường chỗ."""
+        for jobs in self.jobs_by_game.values():
+            for job in jobs:
+                if job.ponder and not job.cancelled:
+                    job.cancel(); return
+
+    def submit(self, gid, board, player, level, time_budget=None, ponder=False):
+        """Gửi thế cờ hiện tại của board đi tìm nước. Ném EngineBusy nếu quá tải."""
+        if not ponder and self.stats["in_flight"] >= self.workers: self._preempt_ponder()
+        if time_budget is None: time_budget = level_time_limit(level)
+        deadline = self._deadline(time_budget)
+        pos = board.to_position()
+        key = self.cache_key(board, player, level)
+        if level == 'mcts':
+            # Root parallel: mỗi process 1 cây riêng (seed khác nhau), gộp visits ở gốc
+            n = max(1, min(MCTS_PARALLEL, self.workers, len(self.free_slots)))
+            return self._dispatch(gid, n, lambda slots: [(_mcts_job, pos, player, deadline, slot, i)
+                                                         for i, slot in enumerate(slots)],
+                                  deadline, _combine_mcts, key, ponder)
+        return self._dispatch(gid, 1, lambda slots: [(_search_job, pos, player, level, deadline, slots[0])],
+                              deadline, None, key, ponder)
+
+    def submit_analysis(self, gid, pos, player, played, level, time_budget):
+        """1 thế cờ của lượt phân tích ván: nước tốt nhất + điểm của nước đã đi (played)."""
+        deadline = self._deadline(time_budget)
+        return self._dispatch(gid, 1, lambda slots: [(_analyze_job, pos, player, played, level, deadline, slots[0])],
+                              deadline)
+
+    def _dispatch(self, gid, n_slots, make_calls, deadline, combine=None, key=None, ponder=False):
+        if self.executor is None: self.start()
+        if not self.free_slots:
+            self.stats["rejected"] += 1
+            raise EngineBusy()
+        slots = [self.free_slots.pop() for _ in range(min(n_slots, len(self.free_slots)))]
+        calls = make_calls(slots)
+        for slot in slots: self.cancel_flags[slot] = 0
+        try:
+            cfutures = [self.executor.submit(*call) for call in calls]
+        except BrokenProcessPool:
+            # Worker chết (OOM, bị kill...): dựng lại pool rồi gửi lại
+            self._restart()
+            cfutures = [self.executor.submit(*call) for call in calls]
+
+        job = EngineJob(self, gid, slots, cfutures, deadline, combine, key, ponder)
+        job.future.add_done_callback(lambda _: self._release(job))
+        self.jobs_by_game.setdefault(gid, set()).add(job)
+        if key is not None: self.pending[key] = job
+        self.stats["submitted"] += 1
+        self.stats["in_flight"] += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+        return job
+
+    async def analyze(self, gid, items, level, time_per_move):
+        """
+        Phân tích nhiều thế cờ song song, trả dần (index, kết quả hoặc Exception) theo thứ tự xong trước.
+        items: [(index, position, bên đi, nước đã đi)]. Giữ tối đa số worker job cùng lúc để không chiếm hết hàng đợi.
+        """
+        items = list(items); nxt = 0; running = {}
+        try:
+            while nxt < len(items) or running:
+                while nxt < len(items) and len(running) < self.workers:
+                    index, pos, player, played = items[nxt]
+                    try: job = self.submit_analysis(gid, pos, player, played, level, time_per_move)
+                    except EngineBusy: break
+                    running[asyncio.ensure_future(job.result())] = (index, job); nxt += 1
+                if not running:
+                    # Engine đang đầy job của người khác: chờ chút rồi thử lại
+                    await asyncio.sleep(POLL_INTERVAL); continue
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, _ = running.pop(task)
+                    yield index, task.exception() or task.result()
+        finally:
+            # Client bỏ giữa chừng: hủy phần còn lại
+            for task, (_, job) in running.items(): job.cancel(); task.cancel()
+
+    def cancel_game(self, gid):
+        """Hủy mọi job của 1 ván (vd: người chơi undo)."""
+        for job in list(self.jobs_by_game.get(gid, ())): job.cancel()
+
+    def _release(self, job):
+        for slot in job.slots:
+            self.cancel_flags[slot] = 0
+            self.free_slots.append(slot)
+        jobs = self.jobs_by_game.get(job.gid)
+        if jobs is not None:
+            jobs.discard(job)
+            if not jobs: del self.jobs_by_game[job.gid]
+        if job.key is not None and self.pending.get(job.key) is job: del self.pending[job.key]
+        self.stats["in_flight"] -= 1
+        err = job.error()
+        if job.cancelled or isinstance(err, asyncio.CancelledError):
+            self.stats["cancelled"] += 1
+        elif err is not None:
+            self.stats["failed"] += 1
+            # N job cùng chết theo 1 pool: chỉ job đầu dựng lại, không đập pool mới đã thay vào
+            if isinstance(err, BrokenProcessPool) and job.executor is self.executor: self._restart()
+        else:
+            self.stats["completed"] += 1
+            self.stats["total_latency"] += time.time() - job.submitted_at
+            if job.key is not None and not job.value()["aborted"]: self._cache_put(job.key, job.value())
+
+    def _restart(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._new_executor()
+
+    def snapshot_stats(self):
+        s = dict(self.stats)
+        s["queued"] = max(0, s["in_flight"] - self.workers)
+        s["capacity"] = self.max_in_flight
+        s["cached"] = len(self.cache)
+        s["avg_latency"] = s.pop("total_latency") / s["completed"] if s["completed"] else 0.0
+        return s
+
+engine = EngineService()
@@ -0,0 +1,140 @@
+import datetime
+import os
+
+from sqlalchemy.exc import IntegrityError
+
+from app.models_db import SessionLocal, GameMove, GameSnapshot
+from app.game_logic.board import GoBoard
+
+# --- CẤU HÌNH ---
+SNAPSHOT_EVERY = int(os.environ.get("COVAY_SNAPSHOT_EVERY", 32)) # Ghi ảnh ván sau mỗi N thao tác
+PRUNE_BATCH = 500 # Số ván xóa mỗi lượt prune()
+
+# Loại thao tác trong nhật ký
+MOVE = 0
+PASS = 1
+UNDO = 2
+
+class StaleGame(Exception):
+    """Worker khác đã ghi thao tác mới hơn cho ván này: phải nạp lại rồi làm lại."""
+
+def apply_record(board, kind, code):
+    """Làm lại 1 dòng nhật ký trên board (đúng thứ tự thì luôn hợp lệ)."""
+    if kind == MOVE:
+        r, c = board.tables.to_coord(code & 0xFFF)
+        board.make_move(r, c, code >> 12)
+    elif kind == PASS: board.pass_turn()
+    else: board.undo_round()
+
+class GameJournal:
+    """
+    Nhật ký ván chỉ ghi thêm (bảng game_moves, 1 INSERT nhỏ mỗi nước) + ảnh gọn định kỳ (game_snapshots).
+    Worker nào cũng nạp được ván theo id: ảnh mới nhất rồi làm lại phần đuôi.
+    Mỗi lần ghi ảnh thì xóa các dòng ảnh đã phủ, nên mỗi ván giữ tối đa snapshot_every dòng.
+    Ván kết thúc thì xóa hẳn; ván bỏ dở bị prune() xóa khi quá hạn (theo game_snapshots.updated_at).
+    """
+
+    def __init__(self, snapshot_every=SNAPSHOT_EVERY):
+        self.snapshot_every = snapshot_every
+
+    def create(self, gid, board):
+        db = SessionLocal()
+        try:
+            db.add(GameSnapshot(game_id=gid, seq=board.version, data=board.export_moves()))
+            db.commit()
+        finally: db.close()
+
+    def delete(self, gid):
+        db = SessionLocal()
+        try:
+            self._delete(db, [gid]); db.commit()
+        finally: db.close()
+
+    @staticmethod
+    def _delete(db, gids):
+        db.query(GameMove).filter(GameMove.game_id.in_(gids)).delete(synchronize_session=False)
+        db.query(GameSnapshot).filter(GameSnapshot.game_id.in_(gids)).delete(synchronize_session=False)
+
+    def prune(self, cutoff, keep=()):
+        """Xóa ván không ghi gì từ trước cutoff (timestamp), trừ các id trong keep. Trả về số ván đã xóa."""
+        cutoff = datetime.datetime.utcfromtimestamp(cutoff)
+        db = SessionLocal(); n = 0; last = ""
+        try:
+            while True:
+                gids = [g for (g,) in db.query(GameSnapshot.game_id)
+                        .filter(GameSnapshot.updated_at < cutoff, GameSnapshot.game_id > last)
+                        .order_by(GameSnapshot.game_id).limit(PRUNE_BATCH)]
+                if not gids: return n
+                last = gids[-1]
+                gids = [g for g in gids if g not in keep]
+                if gids: self._delete(db, gids); db.commit(); n += len(gids)
+        finally: db.close()
+
+    def append(self, gid, board, kind):
+        """
+        Ghi thao tác vừa làm trên board (seq = board.version). Ném StaleGame nếu seq đã có người ghi.
+        Ván vừa kết thúc thì xóa nhật ký (không cần nạp lại nữa); ván đã bị xóa mà còn đánh tiếp
+        (undo sau khi hết ván, ván bị prune lúc đang mở) thì ghi lại ảnh mới.
+        """
+        if board.is_game_over:
+            self.delete(gid); return
+        code = 0
+        if kind != UNDO:
+            delta = board.history_stack[-1]
+            code = delta.color << 12 | delta.point
+        db = SessionLocal()
+        try:
+            db.add(GameMove(game_id=gid, seq=board.version, kind=kind, code=code))
+            write_snap = board.version % self.snapshot_every == 0
+            if not write_snap:
+                # Chỉ đánh dấu vừa ghi (cho prune); 0 dòng = ván đã bị xóa thì ghi ảnh mới
+                write_snap = not (db.query(GameSnapshot).filter(GameSnapshot.game_id == gid)
+                                  .update({GameSnapshot.updated_at: datetime.datetime.utcnow()}, synchronize_session=False))
+            if write_snap:
+                snap = db.get(GameSnapshot, gid)
+                if snap is None: db.add(GameSnapshot(game_id=gid, seq=board.version, data=board.export_moves()))
+                else: snap.seq = board.version; snap.data = board.export_moves()
+                # Ảnh đã phủ các dòng cũ: xóa đi, giữ dòng seq hiện tại để worker ghi trùng seq vẫn bị UNIQUE chặn
+                (db.query(GameMove).filter(GameMove.game_id == gid, GameMove.seq < board.version)
+                 .delete(synchronize_session=False))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise StaleGame()
+        finally: db.close()
+
+    def load(self, gid):
+        """Dựng ván từ ảnh mới nhất + đuôi nhật ký. None nếu không có ván này."""
+        db = SessionLocal()
+        try:
+            snap = db.get(GameSnapshot, gid)
+            if snap is None: return None
+            board = GoBoard.from_moves(snap.data)
+            self._replay_tail(db, gid, board)
+            return board
+        finally: db.close()
+
+    def sync(self, gid, board):
+        """
+        Áp các thao tác worker khác đã ghi sau board.version. Trả về số dòng đã áp.
+        Ném StaleGame nếu các dòng cần áp đã bị dọn (board cũ hơn ảnh mới nhất) hoặc ván đã bị xóa
+        (worker khác đánh nước kết thúc, prune): phải nạp lại bằng load().
+        """
+        db = SessionLocal()
+        try: return self._replay_tail(db, gid, board, contiguous=True)
+        finally: db.close()
+
+    def _replay_tail(self, db, gid, board, contiguous=False):
+        rows = (db.query(GameMove.seq, GameMove.kind, GameMove.code)
+                .filter(GameMove.game_id == gid, GameMove.seq > board.version)
+                .order_by(GameMove.seq).all())
+        if contiguous:
+            if rows and rows[0][0] != board.version + 1: raise StaleGame()
+            if not rows and db.get(GameSnapshot, gid) is None: raise StaleGame()
+        for seq, kind, code in rows:
+            apply_record(board, kind, code)
+            # Phòng hờ: dòng nào không áp được thì version vẫn phải khớp seq
+            board.version = seq
+        return len(rows)
+
+journal = GameJournal()
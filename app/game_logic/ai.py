@@ -1,9 +1,22 @@
 import math
 import random
-import copy
 import traceback
 import time
 from app.game_logic.board import BLACK, WHITE, EMPTY
+from app.game_logic.transposition import TranspositionTable, EXACT, LOWER, UPPER
+from app.game_logic.tables import get_tables
+from app.game_logic import features
+from app.game_logic.book import get_book
+
+MAX_SEARCH_DEPTH = 20 # Trần độ sâu của iterative deepening (thực tế dừng theo thời gian)
+TIME_LIMITS = {'easy': 1.0, 'medium': 3.0, 'hard': 5.0, 'mcts': 5.0} # Giây suy nghĩ theo level
+
+def level_time_limit(level):
+    level = level.lower() if level else 'medium'
+    return TIME_LIMITS.get(level, TIME_LIMITS['hard'])
+
+class SearchTimeout(Exception):
+    """Hết giờ giữa chừng: bỏ lượt lặp đang dở, giữ kết quả độ sâu trước."""
 
 class AIPlayer:
     def __init__(self, board_size, level='hard'):
@@ -15,42 +28,57 @@ class AIPlayer:
             # EASY: "Khôn tí" (Nghĩ 1 nước - Greedy)
             self.depth = 1          
             self.max_candidates = 5 
-            self.time_limit = 1.0   
+            self.time_limit = TIME_LIMITS['easy']
             self.randomness = 500 # Có sai sót
             
         elif self.level == 'medium':
             # MEDIUM: Nghĩ 2 nước
             self.depth = 2
             self.max_candidates = 10
-            self.time_limit = 3.0
+            self.time_limit = TIME_LIMITS['medium']
             self.randomness = 100 
             
         else: # HARD
             # HARD: Chiến thần suy nghĩ 5 giây
-            self.time_limit = 5.0 # <--- ĐÚNG Ý CẬU: 5 GIÂY
+            self.time_limit = TIME_LIMITS['hard'] # <--- ĐÚNG Ý CẬU: 5 GIÂY
             self.randomness = 0 # Đánh chuẩn 100%
             
-            # Cấu hình độ sâu để tận dụng hết 5s
+            # Iterative deepening: đào sâu dần tới khi hết 5s
+            self.depth = MAX_SEARCH_DEPTH
             if self.size <= 9:
-                self.depth = 6 
                 self.max_candidates = 40
             elif self.size <= 13:
-                self.depth = 4 
                 self.max_candidates = 25
             else: 
-                self.depth = 3 
                 self.max_candidates = 20
 
-        # Heatmap
-        self.position_weights = [[0] * self.size for _ in range(self.size)]
-        for r in range(self.size):
-            for c in range(self.size):
-                dist = min(r, c, self.size - 1 - r, self.size - 1 - c)
-                if dist >= 2: self.position_weights[r][c] = 10 
-                elif dist == 1: self.position_weights[r][c] = 2
-                else: self.position_weights[r][c] = -2 
+        # Heatmap, hàng xóm, điểm sao...: bảng dùng chung theo kích thước bàn
+        self.tables = get_tables(self.size)
+
+        # Có NumPy: sinh ứng viên bằng phép toán mảng trên cả bàn
+        self.vectorized = features.available()
+        self.np_rng = features.np.random.default_rng() if self.vectorized else None
+
+        # Sách khai cuộc (chỉ HARD): có nước sách thì trả ngay, khỏi tìm
+        self.use_book = self.level == 'hard'
 
         self.start_time = 0
+        # Hàm hủy từ bên ngoài (engine service): trả True thì dừng như hết giờ
+        self.should_stop = None
+        # Bảng băm thế cờ (điểm tính theo góc nhìn của tt_player)
+        self.tt = TranspositionTable()
+        self.tt_player = None
+
+        # Sắp xếp nước: 2 killer move mỗi ply + bảng history theo (màu, ô)
+        area = (self.size + 2) ** 2
+        self.killers = [[None, None] for _ in range(MAX_SEARCH_DEPTH + 1)]
+        self.history = {BLACK: [0] * area, WHITE: [0] * area}
+
+        # Thống kê lượt tìm gần nhất
+        self.nodes = 0
+        self.last_depth = 0
+        self.last_score = None
+        self.last_pv = []
 
     # --- CHIẾN THUẬT (HARD) ---
     def analyze_tactics(self, board, r, c, player):
@@ -59,163 +87,267 @@ class AIPlayer:
         score = 0
         opp = BLACK if player == WHITE else WHITE
         
+        p = board.point(r, c); grid = board.board
+        
         # Cắt quân (Cutting)
         cuts = 0
-        for dr, dc in [(-1,-1),(-1,1),(1,-1),(1,1)]:
-            nr, nc = r+dr, c+dc
-            if board.is_valid_coord(nr, nc) and board.grid[nr][nc] == opp:
-                cuts += 1
+        for q in board.tables.diagonals[p]:
+            if grid[q] == opp: cuts += 1
         if cuts >= 2: score += 400 
 
         # Áp sát (Hane)
-        adj_opp = 0
-        for dr, dc in [(-1,0),(1,0),(0,-1),(0,1)]:
-            nr, nc = r+dr, c+dc
-            if board.is_valid_coord(nr, nc) and board.grid[nr][nc] == opp:
-                adj_opp += 1
-        if adj_opp > 0: score += 50 
+        for q in board.tables.neighbors[p]:
+            if grid[q] == opp:
+                score += 50; break
 
         return score
 
     # --- HÀM TÌM KHÍ ---
     def get_liberties(self, board, r, c):
-        color = board.grid[r][c]
-        if color == EMPTY: return 0
-        stack = [(r, c)]; visited = {(r, c)}; libs = 0
-        while stack:
-            cr, cc = stack.pop()
-            for dr, dc in [(-1,0),(1,0),(0,-1),(0,1)]:
-                nr, nc = cr + dr, cc + dc
-                if board.is_valid_coord(nr, nc):
-                    if board.grid[nr][nc] == EMPTY: 
-                        libs += 1
-                        if libs > 5: return 5 
-                    elif board.grid[nr][nc] == color and (nr, nc) not in visited:
-                        visited.add((nr, nc)); stack.append((nr, nc))
-        return libs
+        # Tra khí từ bản ghi chuỗi của bàn cờ (tối đa 5 như trước)
+        p = board.point(r, c)
+        if not board.chain_head[p]: return 0
+        return min(len(board.chain_libs[board.chain_head[p]]), 5)
 
     def evaluate(self, board, player):
-        score = 0
+        """
+        Đánh giá O(1): mọi số hạng (quân, trọng số vị trí, quân trong chuỗi 1-2 khí)
+        được GoBoard giữ tăng dần qua play/unplay.
+        """
+        opp = BLACK if player == WHITE else WHITE
         my_cap = board.captured_white if player == WHITE else board.captured_black
         opp_cap = board.captured_black if player == WHITE else board.captured_white
-        
-        score += (my_cap - opp_cap) * 10000 
-
-        for r in range(self.size):
-            for c in range(self.size):
-                if board.grid[r][c] == player:
-                    score += 10 + self.position_weights[r][c]
-                    
-                    libs = self.get_liberties(board, r, c)
-                    if libs == 1: score -= 50000 
-                    elif libs == 2: score -= 5000
-
-                elif board.grid[r][c] != EMPTY:
-                    score -= 10
-                    libs = self.get_liberties(board, r, c)
-                    if libs == 1: score += 40000 
-                    elif libs == 2: score += 3000
+        my_libs = board.lib_stones[player]; opp_libs = board.lib_stones[opp]
 
+        score = (my_cap - opp_cap) * 10000 
+        score += 10 * board.stone_count[player] + board.weight_sum[player]
+        score -= 10 * board.stone_count[opp]
+        score -= 50000 * my_libs[1] + 5000 * my_libs[2]
+        score += 40000 * opp_libs[1] + 3000 * opp_libs[2]
         return score
 
-    def get_candidate_moves(self, board, player):
+    def score_candidates(self, board, player):
+        """Điểm ưu tiên tĩnh {(r, c): điểm} của các ô trống gần quân (cũng là prior cho MCTS)."""
+        if self.vectorized:
+            idx, scores = features.candidate_scores(board, player, self.level == 'hard', self.np_rng)
+            candidates = {divmod(i, self.size): s for i, s in zip(idx.tolist(), scores.tolist())}
+            return self.add_star_points(board, candidates)
         candidates = {}
-        for r in range(self.size):
-            for c in range(self.size):
-                if board.grid[r][c] != EMPTY:
-                    for dr in range(-2, 3):
-                        for dc in range(-2, 3):
-                            nr, nc = r+dr, c+dc
-                            if board.is_valid_coord(nr, nc) and board.grid[nr][nc] == EMPTY:
-                                if (nr,nc) in candidates: continue
-                                
-                                p = self.position_weights[nr][nc] + random.randint(0, 5)
-                                if self.level == 'hard':
-                                    p += self.analyze_tactics(board, nr, nc, player)
-
-                                candidates[(nr, nc)] = p
-        
+        grid = board.board; t = self.tables
+        weights = t.position_weights; to_coord = t.to_coord
+        for p in t.points:
+            if grid[p] != EMPTY:
+                for q in t.near[p]:
+                    if grid[q] == EMPTY:
+                        move = to_coord(q)
+                        if move in candidates: continue
+
+                        score = weights[q] + random.randint(0, 5)
+                        if self.level == 'hard':
+                            score += self.analyze_tactics(board, move[0], move[1], player)
+
+                        candidates[move] = score
+        return self.add_star_points(board, candidates)
+
+    def add_star_points(self, board, candidates):
         if len(candidates) < 5:
-            stars = [(2,2), (2,self.size-3), (self.size-3,2), (self.size-3,self.size-3), (self.size//2, self.size//2)]
-            for p in stars:
-                if board.is_valid_coord(p[0],p[1]) and board.grid[p[0]][p[1]] == EMPTY:
-                    candidates[p] = 500
+            for p in self.tables.star_points:
+                if board.board[p] == EMPTY:
+                    candidates[self.tables.to_coord(p)] = 500
+        return candidates
 
+    def get_candidate_moves(self, board, player):
+        if self.vectorized:
+            idx, scores = features.candidate_scores(board, player, self.level == 'hard', self.np_rng)
+            # Ít ứng viên quá thì đi đường dict để thêm điểm sao
+            if idx.size >= 5:
+                return [divmod(i, self.size) for i in features.top_candidates(idx, scores, self.max_candidates)]
+        candidates = self.score_candidates(board, player)
         sorted_moves = sorted(candidates.items(), key=lambda x: x[1], reverse=True)
         return [move for move, _ in sorted_moves[:self.max_candidates]]
 
-    def minimax(self, board, depth, alpha, beta, maximizing, player):
-        # Kiểm tra thời gian: Nếu quá 5s thì dừng ngay lập tức
+    def order_moves(self, board, moves, curr, ply, tt_move):
+        """PV/TT move trước, rồi killer move, còn lại theo điểm history (giữ thứ tự tĩnh khi hòa)."""
+        hist = self.history[curr]; to_point = board.tables.to_point
+        moves.sort(key=lambda m: -hist[to_point(m[0], m[1])])
+        first = [m for m in self.killers[ply] if m is not None and m != tt_move and m in moves]
+        if tt_move in moves: first.insert(0, tt_move)
+        if not first: return moves
+        return first + [m for m in moves if m not in first]
+
+    def record_cutoff(self, board, move, curr, ply, depth, captured):
+        # Nước ăn quân tự lên đầu nhờ điểm tĩnh, chỉ ghi nhớ nước "yên"
+        if captured: return
+        hist = self.history[curr]
+        hist[board.tables.to_point(move[0], move[1])] += depth * depth
+        killers = self.killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]; killers[0] = move
+
+    def minimax(self, board, depth, alpha, beta, maximizing, player, ply=0):
+        # Kiểm tra thời gian: hết giờ thì bỏ cả lượt lặp đang dở
         if time.time() - self.start_time > self.time_limit:
-            return self.evaluate(board, player), None
+            raise SearchTimeout()
+        self.nodes += 1
+        if self.should_stop is not None and not self.nodes & 63 and self.should_stop():
+            raise SearchTimeout()
             
         if depth == 0: return self.evaluate(board, player), None
+
+        # Tra bảng băm: đủ sâu thì dùng luôn điểm / cận đã lưu
+        key = board.search_key()
+        tt_move = None
+        entry = self.tt.get(key)
+        if entry is not None:
+            _, e_depth, e_score, e_flag, tt_move, _ = entry
+            if e_depth >= depth:
+                if e_flag == EXACT: return e_score, tt_move
+                if e_flag == LOWER and e_score >= beta: return e_score, tt_move
+                if e_flag == UPPER and e_score <= alpha: return e_score, tt_move
+        alpha_orig, beta_orig = alpha, beta
         
         opp = BLACK if player == WHITE else WHITE
         curr = player if maximizing else opp
         moves = self.get_candidate_moves(board, curr)
         
         if not moves: return self.evaluate(board, player), None
+        moves = self.order_moves(board, moves, curr, ply, tt_move)
 
         best_move = None
         
         if maximizing:
             max_eval = -math.inf
             for r, c in moves:
-                if not board.is_valid_move(r, c, curr)[0]: continue
+                if not board.is_legal_point(board.point(r, c), curr): continue
+                # Đánh thử trên chính bàn cờ rồi hoàn tác bằng delta (không copy)
+                delta = board.play((r, c), curr)
                 try:
-                    temp = copy.deepcopy(board)
-                    temp.grid[r][c] = curr
-                    captured = temp.handle_captures(r, c, curr)
-                    
-                    eval_score, _ = self.minimax(temp, depth - 1, alpha, beta, False, player)
+                    eval_score, _ = self.minimax(board, depth - 1, alpha, beta, False, player, ply + 1)
+                finally: board.unplay(delta)
                     
-                    if self.randomness > 0:
-                        eval_score += random.randint(-self.randomness, self.randomness)
-
-                    total = eval_score + (captured * 10000)
-                    if total > max_eval: max_eval = total; best_move = (r, c)
-                    alpha = max(alpha, total)
-                    if beta <= alpha: break
-                except: continue
-            return max_eval, best_move
+                if self.randomness > 0:
+                    eval_score += random.randint(-self.randomness, self.randomness)
+
+                total = eval_score + (delta.n_captured * 10000)
+                if total > max_eval: max_eval = total; best_move = (r, c)
+                alpha = max(alpha, total)
+                if beta <= alpha:
+                    self.record_cutoff(board, (r, c), curr, ply, depth, delta.n_captured)
+                    break
+            best_eval = max_eval
         else:
             min_eval = math.inf
             for r, c in moves:
-                if not board.is_valid_move(r, c, curr)[0]: continue
+                if not board.is_legal_point(board.point(r, c), curr): continue
+                # Đánh thử trên chính bàn cờ rồi hoàn tác bằng delta (không copy)
+                delta = board.play((r, c), curr)
                 try:
-                    temp = copy.deepcopy(board)
-                    temp.grid[r][c] = curr
-                    captured = temp.handle_captures(r, c, curr)
+                    eval_score, _ = self.minimax(board, depth - 1, alpha, beta, True, player, ply + 1)
+                finally: board.unplay(delta)
                     
-                    eval_score, _ = self.minimax(temp, depth - 1, alpha, beta, True, player)
-                    
-                    if self.randomness > 0:
-                        eval_score += random.randint(-self.randomness, self.randomness)
+                if self.randomness > 0:
+                    eval_score += random.randint(-self.randomness, self.randomness)
+
+                total = eval_score - (delta.n_captured * 10000)
+                if total < min_eval: min_eval = total; best_move = (r, c)
+                beta = min(beta, total)
+                if beta <= alpha:
+                    self.record_cutoff(board, (r, c), curr, ply, depth, delta.n_captured)
+                    break
+            best_eval = min_eval
 
-                    total = eval_score - (captured * 10000)
-                    if total < min_eval: min_eval = total; best_move = (r, c)
-                    beta = min(beta, total)
-                    if beta <= alpha: break
-                except: continue
-            return min_eval, best_move
+        if best_move is not None:
+            if best_eval <= alpha_orig: flag = UPPER
+            elif best_eval >= beta_orig: flag = LOWER
+            else: flag = EXACT
+            self.tt.put(key, depth, best_eval, flag, best_move)
+        return best_eval, best_move
+
+    def evaluate_move(self, board, player, move, depth, time_limit):
+        """
+        Điểm (góc nhìn player) của 1 nước cụ thể (None = bỏ lượt), tìm tiếp depth - 1 nước
+        để so được với last_score của get_best_move. None nếu nước sai hoặc hết giờ.
+        """
+        work = board.copy(); work.current_turn = player
+        if move is not None:
+            p = work.point(*move)
+            if work.board[p] != EMPTY or not work.is_legal_point(p, player): return None
+        self.start_time = time.time(); self.time_limit = time_limit
+        delta = work.play(move, player)
+        try:
+            score, _ = self.minimax(work, depth - 1, -math.inf, math.inf, False, player, 1)
+        except SearchTimeout:
+            return None
+        return score + delta.n_captured * 10000
+
+    def principal_variation(self, board, max_len):
+        """Đọc chuỗi nước chính (PV) từ bảng băm, đánh thử rồi hoàn tác."""
+        pv = []; deltas = []
+        while len(pv) < max_len:
+            entry = self.tt.get(board.search_key())
+            if entry is None or entry[4] is None: break
+            r, c = entry[4]
+            p = board.point(r, c)
+            if board.board[p] != EMPTY or not board.is_legal_point(p, board.current_turn): break
+            pv.append((r, c)); deltas.append(board.play((r, c)))
+        while deltas: board.unplay(deltas.pop())
+        return pv
 
     def get_best_move(self, board, player):
-        print(f"🤖 AI Thinking (5s Limit)... Level={self.level.upper()}")
+        print(f"🤖 AI Thinking ({self.time_limit:g}s Limit)... Level={self.level.upper()}")
         self.start_time = time.time()
+        self.nodes = 0; self.last_depth = 0; self.last_score = None; self.last_pv = []
+        book = get_book(self.size) if self.use_book else None
+        if book is not None:
+            move = book.lookup(board, player)
+            if move is not None:
+                print(f"📖 Book Move: {move}")
+                return move
+        self.tt.new_search()
+        if self.tt_player != player:
+            self.tt.clear(); self.tt_player = player
+        for killers in self.killers: killers[0] = killers[1] = None
+        # History cũ giảm một nửa mỗi lượt: vẫn giúp sắp xếp nhưng không lấn thế cờ mới
+        for color in (BLACK, WHITE):
+            self.history[color] = [v >> 1 for v in self.history[color]]
 
+        best_move = None
         try:
-            score, move = self.minimax(board, self.depth, -math.inf, math.inf, True, player)
+            # Tìm trên 1 bản sao duy nhất, mọi nút con dùng play/unplay
+            work = board.copy()
+            work.current_turn = player
+            # Iterative deepening: chỉ nhận nước của độ sâu đã tìm XONG
+            for depth in range(1, self.depth + 1):
+                try:
+                    score, move = self.minimax(work, depth, -math.inf, math.inf, True, player)
+                except SearchTimeout:
+                    break
+                if move is None: break
+                best_move = move; self.last_depth = depth; self.last_score = score
+                self.last_pv = self.principal_variation(work, depth)
+                # Lượt sau tốn gấp nhiều lần lượt này: không đủ giờ thì dừng sớm
+                if time.time() - self.start_time > self.time_limit * 0.4: break
+
             elapsed = time.time() - self.start_time
-            if move:
-                print(f"🔥 AI Move: {move} | Score: {score} | Time: {elapsed:.2f}s")
-                return move
+            if best_move:
+                print(f"🔥 AI Move: {best_move} | Score: {self.last_score} | Depth: {self.last_depth} | Nodes: {self.nodes} | Time: {elapsed:.2f}s")
+                return best_move
         except:
             traceback.print_exc()
 
         # Fallback
         for r in range(self.size):
             for c in range(self.size):
-                if board.grid[r][c] == EMPTY and board.is_valid_move(r, c, player)[0]:
+                if board.get(r, c) == EMPTY and board.is_valid_move(r, c, player)[0]:
                     return (r, c)
-        return None
\ No newline at end of file
+        return None
+
+# Engine dùng lại theo (size, level, bên đi) trong mỗi process: giữ bảng history / TT giữa các nước.
+# Tách theo bên đi vì TT lưu điểm theo góc nhìn 1 bên (đổi bên là phải xóa).
+_engine_pool = {}
+
+def get_engine(size, level, player=None):
+    key = (size, level.lower() if level else 'medium', player)
+    ai = _engine_pool.get(key)
+    if ai is None: ai = _engine_pool[key] = AIPlayer(size, key[1])
+    return ai
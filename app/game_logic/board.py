@@ -1,4 +1,7 @@
-import copy
+import struct
+from collections import deque
+
+from app.game_logic.tables import get_tables
 
 # --- HẰNG SỐ ---
 EMPTY = 0
@@ -6,11 +9,69 @@ BLACK = 1
 WHITE = 2
 DEAD_BLACK = 3 # Xác Đen
 DEAD_WHITE = 4 # Xác Trắng
+BORDER = 7 # Ô viền ngoài bàn cờ (chỉ có trong mảng phẳng)
+
+# Ô Trống và Xác Chết đều tính là KHÍ
+LIBERTY_VALUES = frozenset((EMPTY, DEAD_BLACK, DEAD_WHITE))
+KOMI = 7.5
+CHANGE_LOG_SIZE = 64 # Số phiên bản gần nhất còn trả được dạng delta cho client
+PACK_TABLE = bytes.maketrans(bytes(range(5)), b'01234') # Giá trị ô -> ký tự
+
+class MoveDelta:
+    """
+    Những gì 1 nước đi đã thay đổi (đủ để unplay), thay cho snapshot cả bàn cờ.
+    point = 0 nghĩa là Bỏ lượt.
+    """
+    __slots__ = ('point', 'color', 'counters', 'hash', 'base', 'base_len', 'added_libs', 'absorbed', 'captured', 'n_captured')
+
+    def __init__(self, point, color, counters, hash):
+        self.point = point
+        self.color = color
+        self.counters = counters    # (captured_black, captured_white, current_turn, consecutive_passes, is_game_over)
+        self.hash = hash            # Khóa Zobrist trước nước đi
+        self.base = 0               # Chuỗi nhận quân mới (0 = quân mới tạo chuỗi riêng)
+        self.base_len = 0           # Số quân của chuỗi base trước khi nối
+        self.added_libs = None      # Khí mới thêm vào chuỗi base
+        self.absorbed = None        # [(head, stones, libs)] các chuỗi bị nối vào base
+        self.captured = None        # [(head, stones)] các chuỗi bị ăn
+        self.n_captured = 0
+
+    def changed_points(self):
+        """Các ô đổi giá trị vì nước này (ô đặt quân + quân bị ăn)."""
+        if not self.point: return []
+        points = [self.point]
+        if self.captured:
+            for _, stones in self.captured: points.extend(stones)
+        return points
 
 class GoBoard:
     def __init__(self, size=9):
         self.size = size
-        self.grid = [[EMPTY for _ in range(size)] for _ in range(size)]
+        self.tables = get_tables(size)
+
+        # Bàn cờ phẳng 1 chiều có viền (xem tables.py), grid chỉ là view cho API
+        self.board = bytearray([BORDER]) * self.tables.area
+        for p in self.tables.points: self.board[p] = EMPTY
+
+        # Bản ghi chuỗi quân (chain) cập nhật tăng dần:
+        # chain_head[p] = ô đại diện của chuỗi chứa p (0 nếu không có quân sống),
+        # chain_stones[head] = list ô của chuỗi, chain_libs[head] = set khí của chuỗi.
+        self.chain_head = [0] * self.tables.area
+        self.chain_stones = [None] * self.tables.area
+        self.chain_libs = [None] * self.tables.area
+
+        # Các số hạng đánh giá tĩnh giữ tăng dần theo chuỗi (đánh giá lá O(1)):
+        # stone_count[màu], weight_sum[màu] = tổng trọng số vị trí của quân sống,
+        # lib_stones[màu][k] = số quân nằm trong chuỗi có k khí (k = 3 nghĩa là >= 3).
+        self.stone_count = [0, 0, 0]
+        self.weight_sum = [0, 0, 0]
+        self.lib_stones = [[0] * 4 for _ in range(3)]
+
+        # Khóa Zobrist của thế cờ (chỉ tính quân/xác, không tính lượt), cập nhật tăng dần.
+        # key_counts đếm các thế cờ đã xuất hiện trong ván thật để chặn lặp (positional superko).
+        self.hash = 0
+        self.key_history = [self.hash]
+        self.key_counts = {self.hash: 1}
         
         self.history_stack = [] 
         self.move_log = []
@@ -21,75 +82,398 @@ class GoBoard:
         self.consecutive_passes = 0
         self.is_game_over = False
 
-    def save_state(self):
-        state = {
-            'grid': copy.deepcopy(self.grid),
+        # Phiên bản thế cờ cho API: tăng mỗi lần đánh/bỏ lượt/undo.
+        # change_log[i] = các ô đổi ở 1 phiên bản, giữ CHANGE_LOG_SIZE phiên bản gần nhất.
+        self.version = 0
+        self.change_log = deque(maxlen=CHANGE_LOG_SIZE)
+        self.score_cache = None # (hash, kết quả score_estimate)
+
+    # --- VIEW 2D CHO API ---
+    @property
+    def grid(self):
+        """Trả về list of lists (tạo mới mỗi lần gọi) để trả JSON. Đừng dùng trong vòng lặp nóng."""
+        w = self.tables.width; b = self.board
+        return [list(b[(r + 1) * w + 1:(r + 1) * w + 1 + self.size]) for r in range(self.size)]
+
+    @grid.setter
+    def grid(self, rows):
+        for r in range(self.size):
+            for c in range(self.size):
+                self.board[self.tables.to_point(r, c)] = rows[r][c]
+        self._rebuild_chains()
+        self._recompute_hash()
+        # Không biết ô nào đổi: bỏ log, client nào cũng phải lấy lại cả bàn
+        self.version += 1; self.change_log.clear()
+
+    def packed(self):
+        """Bàn cờ dạng chuỗi size*size ký tự '0'..'4' theo hàng (gọn hơn grid khi trả JSON)."""
+        w = self.tables.width; b = self.board
+        rows = b''.join(b[(r + 1) * w + 1:(r + 1) * w + 1 + self.size] for r in range(self.size))
+        return rows.translate(PACK_TABLE).decode()
+
+    def _log_change(self, points):
+        self.version += 1
+        self.change_log.append(points)
+
+    def changes_since(self, version):
+        """
+        [[r, c, giá trị], ...] các ô đổi từ phiên bản version tới giờ.
+        None nếu không dựng được (phiên bản lạ hoặc quá cũ): khi đó gửi cả bàn.
+        """
+        behind = self.version - version
+        if behind < 0 or behind > len(self.change_log): return None
+        points = set()
+        for i in range(len(self.change_log) - behind, len(self.change_log)): points.update(self.change_log[i])
+        to_coord = self.tables.to_coord; b = self.board
+        return [[*to_coord(p), b[p]] for p in sorted(points)]
+
+    def point(self, r, c):
+        return self.tables.to_point(r, c)
+
+    def get(self, r, c):
+        return self.board[self.tables.to_point(r, c)]
+
+    def copy(self):
+        """Bản sao rẻ: chép buffer bằng slicing thay vì deepcopy."""
+        new = GoBoard.__new__(GoBoard)
+        new.__dict__.update(self.__dict__)
+        new.board = self.board[:]
+        new.chain_head = self.chain_head[:]
+        new.chain_stones = [s and list(s) for s in self.chain_stones]
+        new.chain_libs = [l and set(l) for l in self.chain_libs]
+        new.stone_count = self.stone_count[:]
+        new.weight_sum = self.weight_sum[:]
+        new.lib_stones = [row[:] for row in self.lib_stones]
+        new.history_stack = list(self.history_stack)
+        new.move_log = list(self.move_log)
+        new.key_history = list(self.key_history)
+        new.key_counts = dict(self.key_counts)
+        new.change_log = deque(self.change_log, maxlen=CHANGE_LOG_SIZE)
+        return new
+
+    def to_position(self):
+        """Thế cờ gọn (buffer phẳng + bộ đếm, không kèm lịch sử) để gửi sang process khác."""
+        return {
+            'size': self.size,
+            'board': bytes(self.board),
             'captured_black': self.captured_black,
             'captured_white': self.captured_white,
-            'move_log': list(self.move_log),
             'current_turn': self.current_turn,
             'consecutive_passes': self.consecutive_passes,
             'is_game_over': self.is_game_over
         }
-        self.history_stack.append(state)
+
+    @classmethod
+    def from_position(cls, pos):
+        """Dựng lại GoBoard từ to_position() (chuỗi, khóa Zobrist, số hạng đánh giá tính lại 1 lần)."""
+        board = cls(pos['size'])
+        board.board[:] = pos['board']
+        board.captured_black = pos['captured_black']
+        board.captured_white = pos['captured_white']
+        board.current_turn = pos['current_turn']
+        board.consecutive_passes = pos['consecutive_passes']
+        board.is_game_over = pos['is_game_over']
+        board._rebuild_chains()
+        board._recompute_hash()
+        board.key_history = [board.hash]
+        board.key_counts = {board.hash: 1}
+        return board
+
+    def export_moves(self):
+        """
+        Cả ván (kèm lịch sử để còn undo) dạng bytes gọn: 4 byte trạng thái
+        + 4 byte phiên bản + 2 byte mỗi nước (màu << 12 | ô phẳng, ô 0 = bỏ lượt).
+        """
+        head = struct.pack('<BBBBI', self.size, self.current_turn, self.consecutive_passes, self.is_game_over,
+                           self.version)
+        codes = [d.color << 12 | d.point for d in self.history_stack]
+        return head + struct.pack(f'<{len(codes)}H', *codes)
+
+    @classmethod
+    def from_moves(cls, data):
+        """Dựng lại GoBoard từ export_moves() bằng cách đánh lại từng nước."""
+        size, turn, passes, over, version = struct.unpack_from('<BBBBI', data)
+        board = cls(size)
+        to_coord = board.tables.to_coord
+        for code in struct.unpack_from(f'<{(len(data) - 8) // 2}H', data, 8):
+            color = code >> 12; p = code & 0xFFF
+            # undo_round đặt lại lượt và số lần bỏ lượt: sau undo có thể 1 màu đi 2 nước liền,
+            # hoặc 2 lần bỏ lượt liền mà ván chưa kết thúc -> làm lại y như undo
+            board.current_turn = color
+            if board.is_game_over: board.consecutive_passes = 0; board.is_game_over = False
+            if p:
+                r, c = to_coord(p); board.make_move(r, c, color)
+            else: board.pass_turn()
+        # undo_round có thể đã đặt lại lượt / số lần bỏ lượt
+        board.current_turn = turn; board.consecutive_passes = passes; board.is_game_over = bool(over)
+        # Log đổi không được lưu: client cũ sẽ nhận lại cả bàn
+        board.version = version; board.change_log.clear()
+        return board
+
+    def search_key(self):
+        """Khóa dùng cho bảng băm tìm kiếm: thế cờ + lượt đi."""
+        return self.hash ^ self.tables.zobrist_turn if self.current_turn == WHITE else self.hash
+
+    def _recompute_hash(self):
+        zobrist = self.tables.zobrist; board = self.board; h = 0
+        for p in self.tables.points:
+            if board[p]: h ^= zobrist[board[p]][p]
+        self.hash = h
+
+    def _push_key(self):
+        self.key_history.append(self.hash)
+        self.key_counts[self.hash] = self.key_counts.get(self.hash, 0) + 1
+
+    def _pop_key(self):
+        h = self.key_history.pop()
+        if self.key_counts[h] == 1: del self.key_counts[h]
+        else: self.key_counts[h] -= 1
+
+    def hash_after(self, p, player):
+        """Khóa Zobrist nếu đánh quân player vào ô p (tính cả quân bị ăn), không đổi bàn cờ."""
+        zobrist = self.tables.zobrist; board = self.board
+        opponent = WHITE if player == BLACK else BLACK
+        dead_state = DEAD_BLACK if opponent == BLACK else DEAD_WHITE
+        h = self.hash ^ zobrist[player][p]
+        done = set()
+        for q in self.tables.neighbors[p]:
+            if board[q] != opponent: continue
+            head = self.chain_head[q]
+            if head in done or len(self.chain_libs[head]) != 1: continue
+            done.add(head)
+            for g in self.chain_stones[head]:
+                h ^= zobrist[opponent][g] ^ zobrist[dead_state][g]
+        return h
 
     def is_valid_coord(self, r, c):
         return 0 <= r < self.size and 0 <= c < self.size
 
     def get_neighbors(self, r, c):
-        neighbors = []
-        for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-            nr, nc = r + dr, c + dc
-            if self.is_valid_coord(nr, nc):
-                neighbors.append((nr, nc))
-        return neighbors
-
-    def get_group_liberties(self, r, c, board_state=None):
+        to_coord = self.tables.to_coord
+        return [to_coord(q) for q in self.tables.neighbors[self.tables.to_point(r, c)]]
+
+    def _flood_group(self, p, board):
+        """Loang nhóm chứa ô p trên mảng phẳng. Trả về (tập ô, tập khí)."""
+        color = board[p]
+        neighbors = self.tables.neighbors
+        group = {p}; liberties = set(); stack = [p]
+        while stack:
+            curr = stack.pop()
+            for q in neighbors[curr]:
+                val = board[q]
+                # Cả Ô Trống và Xác Chết đều tính là đường thở (Liberties)
+                if val in LIBERTY_VALUES:
+                    liberties.add(q)
+                # Cùng màu (Quân sống) thì nối nhóm
+                elif val == color and q not in group:
+                    group.add(q); stack.append(q)
+        return group, liberties
+
+    def _rebuild_chains(self):
+        """Dựng lại toàn bộ bản ghi chuỗi từ bàn cờ (chỉ dùng khi nạp/khôi phục trạng thái)."""
+        area = self.tables.area; board = self.board
+        self.chain_head = [0] * area
+        self.chain_stones = [None] * area
+        self.chain_libs = [None] * area
+        for p in self.tables.points:
+            if board[p] in (BLACK, WHITE) and not self.chain_head[p]:
+                group, liberties = self._flood_group(p, board)
+                for q in group: self.chain_head[q] = p
+                self.chain_stones[p] = list(group)
+                self.chain_libs[p] = liberties
+        self._rebuild_eval_terms()
+
+    def _rebuild_eval_terms(self):
+        board = self.board; weights = self.tables.position_weights
+        self.stone_count = [0, 0, 0]
+        self.weight_sum = [0, 0, 0]
+        self.lib_stones = [[0] * 4 for _ in range(3)]
+        for p in self.tables.points:
+            if board[p] in (BLACK, WHITE):
+                self.stone_count[board[p]] += 1
+                self.weight_sum[board[p]] += weights[p]
+                if self.chain_head[p] == p: self._track(p, 1)
+
+    def _track(self, h, sign):
+        """Cộng (sign=1) / trừ (sign=-1) phần đóng góp của chuỗi h vào lib_stones."""
+        n = len(self.chain_libs[h])
+        self.lib_stones[self.board[h]][n if n < 3 else 3] += sign * len(self.chain_stones[h])
+
+    def _heads_around(self, points):
+        """Các chuỗi chứa hoặc kề các ô cho trước (những chuỗi 1 nước đi có thể động tới)."""
+        head_of = self.chain_head; neighbors = self.tables.neighbors
+        heads = set()
+        for x in points:
+            if head_of[x]: heads.add(head_of[x])
+            for q in neighbors[x]:
+                if head_of[q]: heads.add(head_of[q])
+        return heads
+
+    def play(self, move, player=None):
         """
-        Tính Khí: Coi Xác Chết (3,4) và Ô Trống (0) đều là KHÍ.
-        Giúp quân sống không bị nghẹt thở bởi xác chết.
+        Đánh 1 nước ĐÃ kiểm tra hợp lệ (move = (r, c) hoặc None = Bỏ lượt).
+        Trả về MoveDelta chỉ chứa phần thay đổi để unplay(). Không ghi history/move_log.
         """
-        if board_state is None: board_state = self.grid
-        if not self.is_valid_coord(r, c): return set(), 0
-        
-        color = board_state[r][c]
-        if color in [EMPTY, DEAD_BLACK, DEAD_WHITE]: return set(), 0
+        if player is None: player = self.current_turn
+        delta = MoveDelta(0, player, (self.captured_black, self.captured_white, self.current_turn,
+                                      self.consecutive_passes, self.is_game_over), self.hash)
+        self.current_turn = WHITE if player == BLACK else BLACK
+        if move is None:
+            self.consecutive_passes += 1
+            if self.consecutive_passes >= 2: self.is_game_over = True
+            return delta
 
-        group = set(); liberties = set(); queue = [(r, c)]
-        group.add((r, c))
+        p = self.tables.to_point(move[0], move[1])
+        delta.point = p
+        zobrist = self.tables.zobrist
+        self.hash ^= zobrist[player][p]
+        self._place(p, player, delta)
+        captured = self._capture(p, player)
+        if captured:
+            delta.captured = captured
+            delta.n_captured = sum(len(stones) for _, stones in captured)
+            opponent = WHITE if player == BLACK else BLACK
+            z_live = zobrist[opponent]; z_dead = zobrist[DEAD_BLACK if opponent == BLACK else DEAD_WHITE]
+            h = self.hash
+            for _, stones in captured:
+                for g in stones: h ^= z_live[g] ^ z_dead[g]
+            self.hash = h
+            if player == BLACK: self.captured_white += delta.n_captured
+            else: self.captured_black += delta.n_captured
+        self.consecutive_passes = 0
+        return delta
 
-        while queue:
-            curr_r, curr_c = queue.pop(0)
-            for nr, nc in self.get_neighbors(curr_r, curr_c):
-                val = board_state[nr][nc]
-                
-                # Cả Ô Trống và Xác Chết đều tính là đường thở (Liberties)
-                if val in [EMPTY, DEAD_BLACK, DEAD_WHITE]:
-                    liberties.add((nr, nc))
-                
-                # Cùng màu (Quân sống) thì nối nhóm
-                elif val == color and (nr, nc) not in group:
-                    group.add((nr, nc)); queue.append((nr, nc))
-                    
-        return group, len(liberties)
+    def unplay(self, delta):
+        """Hoàn tác đúng 1 nước đã play() (phải theo thứ tự ngược)."""
+        p = delta.point
+        if p:
+            board = self.board; neighbors = self.tables.neighbors
+            head_of = self.chain_head; stones_of = self.chain_stones; libs_of = self.chain_libs
+            color = delta.color; weights = self.tables.position_weights
+
+            # Gỡ đóng góp đánh giá của mọi chuỗi quanh vùng thay đổi, làm xong thì cộng lại
+            changed = [p]
+            if delta.captured:
+                for _, stones in delta.captured: changed.extend(stones)
+            for h in self._heads_around(changed): self._track(h, -1)
+            self.stone_count[color] -= 1; self.weight_sum[color] -= weights[p]
+
+            # 1. Trả lại quân bị ăn, bỏ các khí mà xác chết đã tạo ra
+            if delta.captured:
+                opponent = WHITE if color == BLACK else BLACK
+                for h, stones in delta.captured:
+                    for g in stones:
+                        for n in neighbors[g]:
+                            if board[n] == color: libs_of[head_of[n]].discard(g)
+                    for g in stones:
+                        board[g] = opponent; head_of[g] = h
+                        self.weight_sum[opponent] += weights[g]
+                    stones_of[h] = list(stones); libs_of[h] = set()
+                self.stone_count[opponent] += delta.n_captured
+
+            # 2. Tách các chuỗi đã nối
+            base = delta.base
+            if base:
+                del stones_of[base][delta.base_len:]
+                libs_of[base].difference_update(delta.added_libs)
+                # Trả bản chép, không trả chính object trong delta: delta có thể nằm chung trong
+                # history_stack của board.copy(), 2 bàn cùng undo sẽ dùng chung list / set của chuỗi
+                for h, stones, libs in delta.absorbed:
+                    stones_of[h] = list(stones); libs_of[h] = set(libs)
+                    for s in stones: head_of[s] = h
+            else:
+                stones_of[p] = None; libs_of[p] = None
+
+            # 3. Nhấc quân, p lại là khí của mọi chuỗi kề bên
+            board[p] = EMPTY; head_of[p] = 0
+            for q in neighbors[p]:
+                if board[q] in (BLACK, WHITE): libs_of[head_of[q]].add(p)
+
+            for h in self._heads_around(changed): self._track(h, 1)
+
+        (self.captured_black, self.captured_white, self.current_turn,
+         self.consecutive_passes, self.is_game_over) = delta.counters
+        self.hash = delta.hash
+
+    def _place(self, p, player, delta):
+        """
+        Đặt quân và cập nhật chuỗi tăng dần: bớt khí của chuỗi kề,
+        nối các chuỗi cùng màu kề bên vào chuỗi lớn nhất. Ghi lại vào delta.
+        """
+        board = self.board; head_of = self.chain_head
+        stones_of = self.chain_stones; libs_of = self.chain_libs
+        around = self._heads_around((p,))
+        for h in around: self._track(h, -1)
+        board[p] = player
+        self.stone_count[player] += 1; self.weight_sum[player] += self.tables.position_weights[p]
+
+        my_libs = set(); friends = set()
+        for q in self.tables.neighbors[p]:
+            val = board[q]
+            if val in LIBERTY_VALUES:
+                my_libs.add(q)
+            else:
+                h = head_of[q]
+                libs_of[h].discard(p)
+                if val == player: friends.add(h)
+        for h in around:
+            if h not in friends: self._track(h, 1)
+
+        if not friends:
+            head_of[p] = p; stones_of[p] = [p]; libs_of[p] = my_libs
+            self._track(p, 1)
+            return
+
+        # Nối vào chuỗi lớn nhất, gắn lại nhãn cho các chuỗi nhỏ hơn
+        base = max(friends, key=lambda h: len(stones_of[h]))
+        stones = stones_of[base]; libs = libs_of[base]
+        delta.base = base; delta.base_len = len(stones)
+        added = []; absorbed = []
+        for h in friends:
+            if h == base: continue
+            h_stones = stones_of[h]; h_libs = libs_of[h]
+            absorbed.append((h, h_stones, h_libs))
+            for s in h_stones: head_of[s] = base
+            stones.extend(h_stones)
+            for x in h_libs:
+                if x not in libs: libs.add(x); added.append(x)
+            stones_of[h] = None; libs_of[h] = None
+        stones.append(p); head_of[p] = base
+        for x in my_libs:
+            if x not in libs: libs.add(x); added.append(x)
+        delta.added_libs = added; delta.absorbed = absorbed
+        self._track(base, 1)
 
-    def handle_captures(self, r, c, player):
-        """Ăn quân: Biến quân bị ăn thành XÁC (3 hoặc 4)"""
+    def _capture(self, p, player):
+        """Ăn các chuỗi địch hết khí quanh p. Trả về [(head, stones)] (không cộng điểm)."""
         opponent = WHITE if player == BLACK else BLACK
         dead_state = DEAD_BLACK if opponent == BLACK else DEAD_WHITE
-        captures_made = 0
+        board = self.board; neighbors = self.tables.neighbors
+        head_of = self.chain_head; libs_of = self.chain_libs
+        weights = self.tables.position_weights
+        captured = []
         
-        for nr, nc in self.get_neighbors(r, c):
-            if self.grid[nr][nc] == opponent:
-                group, liberties = self.get_group_liberties(nr, nc)
-                if liberties == 0:
-                    for gr, gc in group:
-                        self.grid[gr][gc] = dead_state 
-                        captures_made += 1
-        
-        if player == BLACK: self.captured_white += captures_made
-        else: self.captured_black += captures_made
-        return captures_made
+        for q in neighbors[p]:
+            if board[q] == opponent and not libs_of[head_of[q]]:
+                h = head_of[q]; group = self.chain_stones[h]
+                self._track(h, -1)
+                self.chain_stones[h] = None; libs_of[h] = None
+                for g in group:
+                    board[g] = dead_state; head_of[g] = 0
+                    self.weight_sum[opponent] -= weights[g]
+                self.stone_count[opponent] -= len(group)
+                captured.append((h, group))
+        if not captured: return captured
+
+        # Xác chết thành khí cho các chuỗi của người ăn quân
+        dead = [g for _, group in captured for g in group]
+        around = self._heads_around(dead)
+        for h in around: self._track(h, -1)
+        for g in dead:
+            for n in neighbors[g]:
+                if board[n] == player: libs_of[head_of[n]].add(g)
+        for h in around: self._track(h, 1)
+        return captured
 
     def is_valid_move(self, r, c, player):
         """Kiểm tra luật chơi (Fixed logic Snapback/Thí quân)"""
@@ -97,145 +481,140 @@ class GoBoard:
         if player != self.current_turn: return False, "Chưa tới lượt bạn!"
         if not self.is_valid_coord(r, c): return False, "Tọa độ sai"
         
-        val = self.grid[r][c]
+        p = self.tables.to_point(r, c)
+        val = self.board[p]
         if val != EMPTY:
-            if val in [DEAD_BLACK, DEAD_WHITE]: return False, "Ô này đã bị ăn"
+            if val in (DEAD_BLACK, DEAD_WHITE): return False, "Ô này đã bị ăn"
             return False, "Ô đã có quân"
 
-        # --- [QUAN TRỌNG] CHECK TỰ SÁT & ĂN QUÂN ---
-        temp_board = copy.deepcopy(self.grid)
-        temp_board[r][c] = player
-        
-        captured_any = False
-        opponent = WHITE if player == BLACK else BLACK
-        
-        # 1. Kiểm tra xem nước này có giết được đám nào của địch không?
-        for nr, nc in self.get_neighbors(r, c):
-            if temp_board[nr][nc] == opponent:
-                # SỬA LỖI Ở ĐÂY: Hứng biến đầu tiên là liberties (khí)
-                res = self.get_group_liberties(nr, nc, temp_board)
-                
-                # Xử lý an toàn dù hàm trả về (khí, group) hay chỉ (khí)
-                if isinstance(res, tuple):
-                    libs = res[0] # Lấy phần tử đầu tiên
-                else:
-                    libs = res
-                
-                # Nếu liberties là list/set thì đếm len, nếu là int thì so sánh
-                lib_count = len(libs) if isinstance(libs, (set, list, tuple)) else libs
-
-                if lib_count == 0:
-                    captured_any = True
-                    break # Chỉ cần ăn được 1 đám là nước đi Hợp lệ ngay (Snapback)
-        
-        # 2. Nếu KHÔNG ăn được ai, mà đặt xuống mình HẾT KHÍ -> LÀ TỰ SÁT -> CẤM
-        if not captured_any:
-            res_my = self.get_group_liberties(r, c, temp_board)
-            
-            # Lấy khí của mình
-            if isinstance(res_my, tuple):
-                my_libs = res_my[0]
-            else:
-                my_libs = res_my
-            
-            my_lib_count = len(my_libs) if isinstance(my_libs, (set, list, tuple)) else my_libs
-
-            if my_lib_count == 0:
-                return False, "Nước đi tự sát (Cấm)"
-
+        if not self.is_legal_point(p, player):
+            return False, "Nước đi tự sát (Cấm)"
+        # Positional superko: cấm lặp lại bất kỳ thế cờ nào đã có trong ván
+        if self.hash_after(p, player) in self.key_counts:
+            return False, "Lặp lại thế cờ (Ko)"
         return True, "OK"
+
+    def is_legal_point(self, p, player):
+        """
+        Check tự sát & ăn quân cho ô trống p (không kiểm tra lượt đi).
+        Chỉ tra khí của các chuỗi kề bên, không loang lại.
+        """
+        board = self.board; head_of = self.chain_head; libs_of = self.chain_libs
+        for q in self.tables.neighbors[p]:
+            val = board[q]
+            # Kề ô trống/xác -> còn khí
+            if val in LIBERTY_VALUES: return True
+            libs = libs_of[head_of[q]]
+            # Nối vào chuỗi mình còn khí khác
+            if val == player:
+                if len(libs) > 1: return True
+            # Ăn được chuỗi địch đang còn 1 khí (Snapback hợp lệ)
+            elif len(libs) == 1: return True
+        # Không ăn được ai mà mình HẾT KHÍ -> TỰ SÁT -> CẤM
+        return False
     
     def make_move(self, r, c, player):
         # Kiểm tra kỹ luật trước khi đánh
         valid, msg = self.is_valid_move(r, c, player)
         if not valid: return False, msg
 
-        self.save_state()
-        self.grid[r][c] = player
-        
-        # Thực hiện ăn quân (nếu có)
-        self.handle_captures(r, c, player)
+        # Đặt quân, nối chuỗi và ăn quân (nếu có); lịch sử chỉ giữ delta
+        delta = self.play((r, c), player)
+        self.history_stack.append(delta)
+        self._push_key()
+        self._log_change(delta.changed_points())
         
         move_str = f"{'Đen' if player == BLACK else 'Trắng'} đánh ({r},{c})"
         self.move_log.append(move_str)
-        self.current_turn = WHITE if player == BLACK else BLACK
-        self.consecutive_passes = 0
         return True, "Thành công"
 
     def pass_turn(self):
-        self.save_state()
-        self.consecutive_passes += 1
         player_name = "Đen" if self.current_turn == BLACK else "Trắng"
+        self.history_stack.append(self.play(None))
+        self._push_key()
+        self._log_change(())
         self.move_log.append(f"{player_name} Bỏ lượt")
-        self.current_turn = WHITE if self.current_turn == BLACK else BLACK
-        if self.consecutive_passes >= 2:
-            self.is_game_over = True
+        if self.is_game_over:
             return True, "Game Over"
         return False, "Đã bỏ lượt"
 
     # --- TÍNH ĐIỂM (Area Scoring) ---
-    def get_territory_owner(self, r, c, visited):
-        queue = [(r, c)]; visited.add((r, c)); region = [(r, c)]
-        touch_black = False; touch_white = False
-        
-        while queue:
-            curr_r, curr_c = queue.pop(0)
-            for nr, nc in self.get_neighbors(curr_r, curr_c):
-                val = self.grid[nr][nc]
-                # Coi cả Ô Trống và Xác Chết là vùng cần duyệt
-                if val in [EMPTY, DEAD_BLACK, DEAD_WHITE]:
-                    if (nr, nc) not in visited:
-                        visited.add((nr, nc)); queue.append((nr, nc)); region.append((nr, nc))
-                elif val == BLACK: touch_black = True
-                elif val == WHITE: touch_white = True
-        
-        if touch_black and not touch_white: return BLACK, region
-        if touch_white and not touch_black: return WHITE, region
-        return 0, region
+    def label_regions(self):
+        """
+        Gán chủ cho mọi ô trong 1 lượt quét union-find trên mảng phẳng (thay cho loang từng vùng).
+        Vùng trống (ô trống + xác) chỉ chạm 1 màu thì thuộc màu đó; xác luôn tính cho bên ăn.
+        Trả về owner: bytearray theo ô phẳng, 0 = không ai.
+        """
+        t = self.tables; w = t.width; board = self.board
+        # Quét theo hàng: mỗi ô chỉ cần xét ô trái và ô trên. root[p] = đại diện vùng của ô trống p,
+        # touch[đại diện] = OR các màu đã chạm (BLACK = 1, WHITE = 2 là bit luôn).
+        root = [0] * t.area; touch = [0] * t.area
+        for p in t.points:
+            v = board[p]
+            if v in LIBERTY_VALUES:
+                a = p
+                left = board[p - 1]; up = board[p - w]
+                if left in LIBERTY_VALUES:
+                    a = root[p - 1]
+                    while root[a] != a: a = root[a]
+                elif left == BLACK or left == WHITE: touch[p] |= left
+                if up in LIBERTY_VALUES:
+                    b = root[p - w]
+                    while root[b] != b: b = root[b]
+                    if a == p: a = b
+                    elif a != b: root[b] = a; touch[a] |= touch[b]
+                elif up == BLACK or up == WHITE: touch[p] |= up
+                root[p] = a
+                if a != p: touch[a] |= touch[p]
+            elif v == BLACK or v == WHITE:
+                for q in (p - 1, p - w):
+                    if board[q] in LIBERTY_VALUES:
+                        while root[q] != q: q = root[q]
+                        touch[q] |= v
+
+        owner = bytearray(t.area)
+        for p in t.points:
+            v = board[p]
+            if v == EMPTY:
+                a = root[p]
+                while root[a] != a: a = root[a]
+                m = touch[a]
+                if m == BLACK or m == WHITE: owner[p] = m
+            elif v == DEAD_BLACK: owner[p] = WHITE
+            elif v == DEAD_WHITE: owner[p] = BLACK
+            else: owner[p] = v
+        return owner
 
     def calculate_score(self):
-        black_score = 0; white_score = 0; visited = set()
-        
-        for r in range(self.size):
-            for c in range(self.size):
-                val = self.grid[r][c]
-                
-                # 1. Quân sống
-                if val == BLACK: black_score += 1
-                elif val == WHITE: white_score += 1
-                
-                # 2. Xác chết (Nằm trên đất địch -> Điểm cho địch)
-                elif val == DEAD_BLACK: white_score += 1
-                elif val == DEAD_WHITE: black_score += 1
-
-                # 3. Đất trống (Dùng loang để tìm chủ)
-                # Chỉ tính ô EMPTY, vì DEAD đã cộng ở bước 2
-                if val in [EMPTY, DEAD_BLACK, DEAD_WHITE] and (r, c) not in visited:
-                    owner, points = self.get_territory_owner(r, c, visited)
-                    empty_count = 0
-                    for pr, pc in points:
-                        if self.grid[pr][pc] == EMPTY: empty_count += 1
-                    
-                    if owner == BLACK: black_score += empty_count
-                    elif owner == WHITE: white_score += empty_count
-        
-        white_score += 7.5
-        return black_score, white_score
+        owner = self.label_regions()
+        return owner.count(BLACK), owner.count(WHITE) + KOMI
+
+    def score_estimate(self):
+        """Chủ từng ô (chuỗi '0'/'1'/'2' theo hàng) + điểm hiện tại. Nhớ theo hash: gọi lại mỗi nước vẫn rẻ."""
+        if self.score_cache is None or self.score_cache[0] != self.hash:
+            owner = self.label_regions()
+            w = self.tables.width; size = self.size
+            rows = b''.join(owner[(r + 1) * w + 1:(r + 1) * w + 1 + size] for r in range(size))
+            self.score_cache = (self.hash, {"black": rows.count(BLACK), "white": rows.count(WHITE) + KOMI,
+                                            "ownership": rows.translate(PACK_TABLE).decode()})
+        return self.score_cache[1]
+
+    def _undo_last(self):
+        delta = self.history_stack.pop()
+        self.unplay(delta); self.move_log.pop(); self._pop_key()
+        return delta.changed_points()
 
     def undo_round(self):
         if len(self.history_stack) >= 2:
-            self.history_stack.pop(); prev_state = self.history_stack.pop()
-            self.grid = prev_state['grid']
-            self.captured_black = prev_state['captured_black']
-            self.captured_white = prev_state['captured_white']
-            self.move_log = prev_state['move_log']
+            changed = self._undo_last() + self._undo_last()
             self.current_turn = BLACK 
             self.consecutive_passes = 0; self.is_game_over = False
+            self._log_change(changed)
             return True, "Đã Undo"
         elif len(self.history_stack) == 1:
-            prev_state = self.history_stack.pop()
-            self.grid = prev_state['grid']
+            changed = self._undo_last()
             self.current_turn = BLACK
             self.consecutive_passes = 0; self.is_game_over = False
+            self._log_change(changed)
             return True, "Về đầu game"
-        return False, "Không thể Undo"
\ No newline at end of file
+        return False, "Không thể Undo"
@@ -0,0 +1,87 @@
+import mmap
+import os
+import struct
+from functools import lru_cache
+
+from app.game_logic.board import EMPTY, WHITE
+
+# --- CẤU HÌNH ---
+BOOK_DIR = os.environ.get("COVAY_BOOK_DIR", os.path.join(os.path.dirname(os.path.dirname(__file__)), "data"))
+BOOK_SIZES = (9, 13, 19)
+
+# File sách: header (magic, phiên bản, size, số bản ghi) + bản ghi cố định xếp tăng theo khóa
+# bản ghi = (khóa chuẩn hóa 64-bit, ô phẳng của nước đi ở khung chuẩn, độ sâu đã tìm)
+MAGIC = b'CVBK'
+HEADER = struct.Struct('<4sHHI')
+RECORD = struct.Struct('<QHH')
+
+def book_path(size):
+    return os.path.join(BOOK_DIR, f"book_{size}.bin")
+
+def canonical_key(board, player):
+    """
+    Khóa Zobrist nhỏ nhất trong 8 ảnh đối xứng của thế cờ (kèm lượt đi).
+    Trả về (khóa, k): k là phép đối xứng đưa thế cờ về khung chuẩn.
+    """
+    t = board.tables; grid = board.board; zobrist = t.zobrist
+    stones = [(p, grid[p]) for p in t.points if grid[p] != EMPTY]
+    turn = t.zobrist_turn if player == WHITE else 0
+    best = None
+    for k, sym in enumerate(t.symmetries):
+        h = turn
+        for p, v in stones: h ^= zobrist[v][sym[p]]
+        if best is None or h < best[0]: best = (h, k)
+    return best
+
+def canonical_move(board, player, move):
+    """Đổi nước (r, c) trên bàn thật sang ô ở khung chuẩn (để ghi vào sách)."""
+    _, k = canonical_key(board, player)
+    return board.tables.symmetries[k][board.tables.to_point(*move)]
+
+class OpeningBook:
+    """Sách khai cuộc chỉ đọc: mmap file rồi tìm nhị phân, không nạp cả file vào RAM."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.size, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != 1:
+            raise ValueError(f"File sách không hợp lệ: {path}")
+
+    def find(self, key):
+        """(ô ở khung chuẩn, độ sâu) của khóa, None nếu không có."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, move, depth = RECORD.unpack_from(self.data, HEADER.size + mid * RECORD.size)
+            if k < key: lo = mid + 1
+            elif k > key: hi = mid
+            else: return move, depth
+        return None
+
+    def lookup(self, board, player):
+        """Nước sách (r, c) cho player ở thế cờ board, đã đổi về đúng hướng bàn thật; None nếu không có."""
+        key, k = canonical_key(board, player)
+        hit = self.find(key)
+        if hit is None: return None
+        t = board.tables
+        p = t.symmetries[t.inverse_symmetry[k]][hit[0]]
+        if board.board[p] != EMPTY or not board.is_legal_point(p, player): return None
+        return t.to_coord(p)
+
+def write_book(path, size, entries):
+    """entries: {khóa: (ô khung chuẩn, độ sâu)}. Ghi file tạm rồi đổi tên để server không đọc file dở."""
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 1, size, len(entries)))
+        for key in sorted(entries):
+            move, depth = entries[key]
+            f.write(RECORD.pack(key, move, depth))
+    os.replace(tmp, path)
+
+@lru_cache(maxsize=None)
+def get_book(size):
+    """Sách của cỡ bàn size (mở 1 lần mỗi process), None nếu chưa build."""
+    path = book_path(size)
+    if size not in BOOK_SIZES or not os.path.exists(path): return None
+    return OpeningBook(path)
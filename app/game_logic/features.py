@@ -0,0 +1,68 @@
+from functools import lru_cache
+
+# NumPy là tùy chọn: không cài thì AIPlayer dùng vòng lặp Python như cũ
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from app.game_logic.board import BLACK, WHITE, EMPTY, BORDER
+from app.game_logic.tables import get_tables
+
+CANDIDATE_RADIUS = 2 # Ứng viên: ô trống trong cửa sổ 5x5 quanh quân
+CUT_BONUS = 400 # >= 2 quân địch ở chéo (Cutting)
+HANE_BONUS = 50 # Có quân địch kề cạnh (Hane)
+
+def available():
+    return np is not None
+
+@lru_cache(maxsize=None)
+def weight_grid(size):
+    """position_weights dạng mảng size x size (chỉ đọc)."""
+    t = get_tables(size)
+    grid = np.ascontiguousarray(np.array(t.position_weights, dtype=np.int32).reshape(t.width, t.width)[1:-1, 1:-1])
+    grid.setflags(write=False)
+    return grid
+
+def _dilate(mask, radius):
+    """Giãn nhị phân bằng cửa sổ vuông (2r+1)x(2r+1): OR các lát cắt dịch theo hàng rồi theo cột."""
+    n = mask.shape[0]
+    padded = np.zeros((n + 2 * radius, n), dtype=bool); padded[radius:radius + n] = mask
+    rows = padded[0:n].copy()
+    for d in range(1, 2 * radius + 1): rows |= padded[d:d + n]
+    padded = np.zeros((n, n + 2 * radius), dtype=bool); padded[:, radius:radius + n] = rows
+    out = padded[:, 0:n].copy()
+    for d in range(1, 2 * radius + 1): out |= padded[:, d:d + n]
+    return out
+
+def candidate_scores(board, player, tactics, rng):
+    """
+    Tính cùng lúc cho cả bàn: mặt nạ ứng viên (giãn mặt nạ quân) và điểm tĩnh
+    (trọng số vị trí + nhiễu 0..5 + cắt/áp sát nếu tactics).
+    Trả về (chỉ số ô trong bàn size x size, điểm) của các ứng viên.
+    """
+    size = board.size
+    g = np.frombuffer(board.board, dtype=np.uint8).reshape(size + 2, size + 2)
+    inner = g[1:-1, 1:-1]
+    # Quân sống và xác đều tính là "có quân" như vòng lặp cũ
+    occupied = (inner != EMPTY) & (inner != BORDER)
+    mask = _dilate(occupied, CANDIDATE_RADIUS) & (inner == EMPTY)
+    idx = np.flatnonzero(mask)
+    if not idx.size: return idx, idx
+
+    scores = weight_grid(size).ravel()[idx] + rng.integers(0, 6, idx.size)
+    if tactics:
+        # Ô viền là BORDER nên không bao giờ bị đếm là quân địch
+        opp = (g == (BLACK if player == WHITE else WHITE)).view(np.uint8)
+        cuts = opp[:-2, :-2] + opp[:-2, 2:] + opp[2:, :-2] + opp[2:, 2:]
+        adj = opp[:-2, 1:-1] | opp[2:, 1:-1] | opp[1:-1, :-2] | opp[1:-1, 2:]
+        scores += np.where(cuts.ravel()[idx] >= 2, CUT_BONUS, 0) + HANE_BONUS * adj.ravel()[idx]
+    return idx, scores
+
+def top_candidates(idx, scores, k):
+    """k ứng viên điểm cao nhất, xếp giảm dần (argpartition rồi chỉ sort phần đầu)."""
+    if idx.size > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        idx = idx[part]; scores = scores[part]
+    order = np.argsort(-scores, kind='stable')
+    return idx[order].tolist()
@@ -0,0 +1,159 @@
+import math
+import random
+import time
+from app.game_logic.board import BLACK, WHITE, EMPTY
+from app.game_logic.ai import get_engine
+
+# --- CẤU HÌNH ---
+UCT_C = 0.7 # Hệ số khám phá
+PRIOR_WEIGHT = 2.0 # Độ nặng của prior (progressive bias), giảm dần theo số lượt thăm
+PRIOR_CANDIDATES = 40 # Số nước ứng viên (lấy từ AIPlayer) cho mỗi nút cây
+PLAYOUT_FACTOR = 2 # Playout dài tối đa PLAYOUT_FACTOR * số ô
+
+class Node:
+    __slots__ = ('move', 'color', 'parent', 'children', 'untried', 'visits', 'wins', 'prior')
+
+    def __init__(self, move, color, parent, prior):
+        self.move = move        # (r, c) vừa đánh để tới nút này, None ở gốc
+        self.color = color      # Màu vừa đánh nước move
+        self.parent = parent
+        self.children = []
+        self.untried = None     # [(prior, move)] xếp tăng dần, mở dần từ cuối (prior cao trước)
+        self.visits = 0
+        self.wins = 0.0
+        self.prior = prior
+
+    def select_child(self):
+        log_n = math.log(self.visits + 1)
+        best = None; best_value = -math.inf
+        for child in self.children:
+            value = (child.wins / child.visits
+                     + UCT_C * math.sqrt(log_n / child.visits)
+                     + PRIOR_WEIGHT * child.prior / (child.visits + 1))
+            if value > best_value: best_value = value; best = child
+        return best
+
+class MCTSSearch:
+    """
+    UCT trên bàn cờ phẳng: cây dùng play/unplay, playout nhẹ ngẫu nhiên (không lấp mắt mình),
+    prior lấy từ position_weights + get_candidate_moves của AIPlayer.
+    """
+
+    def __init__(self, board_size, seed=None):
+        self.size = board_size
+        self.rng = random.Random(seed)
+        # Chỉ dùng score_candidates (không trạng thái) nên dùng chung engine 'hard' của process
+        self.prior_ai = get_engine(board_size, 'hard')
+        self.should_stop = None
+        self.playouts = 0
+
+    # --- PRIOR ---
+    def expand_moves(self, board, color):
+        """Ứng viên hợp lệ kèm prior chuẩn hóa về [0, 1]."""
+        scores = self.prior_ai.score_candidates(board, color)
+        moves = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:PRIOR_CANDIDATES]
+        moves = [(m, s) for m, s in moves if board.is_legal_point(board.point(*m), color)]
+        if not moves: return []
+        lo = min(s for _, s in moves); hi = max(s for _, s in moves)
+        span = (hi - lo) or 1
+        return sorted(((s - lo) / span, m) for m, s in moves)
+
+    # --- PLAYOUT ---
+    def is_own_eye(self, board, p, color):
+        grid = board.board
+        for q in board.tables.neighbors[p]:
+            if grid[q] != color: return False
+        opp = WHITE if color == BLACK else BLACK
+        bad = sum(1 for q in board.tables.diagonals[p] if grid[q] == opp)
+        # Ở biên/góc không được có chéo địch nào, ở giữa chịu được 1
+        return bad == 0 or (bad == 1 and len(board.tables.diagonals[p]) == 4)
+
+    def random_move(self, board, empties, color):
+        """Chọn ngẫu nhiên 1 ô hợp lệ; ô không dùng được bị dồn ra sau đoạn đang xét."""
+        grid = board.board; rng = self.rng
+        n = len(empties)
+        while n:
+            i = rng.randrange(n); p = empties[i]
+            if grid[p] == EMPTY and not self.is_own_eye(board, p, color) and board.is_legal_point(p, color):
+                return p
+            n -= 1
+            empties[i], empties[n] = empties[n], empties[i]
+        return 0
+
+    def playout(self, board):
+        """Đánh ngẫu nhiên tới khi 2 bên cùng bỏ lượt. Trả về màu thắng (điểm khu vực)."""
+        grid = board.board
+        empties = [p for p in board.tables.points if grid[p] == EMPTY]
+        deltas = []; passes = 0
+        to_coord = board.tables.to_coord
+        for _ in range(PLAYOUT_FACTOR * len(board.tables.points)):
+            color = board.current_turn
+            p = self.random_move(board, empties, color)
+            if p:
+                deltas.append(board.play(to_coord(p), color)); passes = 0
+            else:
+                deltas.append(board.play(None, color)); passes += 1
+                if passes >= 2: break
+        black, white = board.calculate_score()
+        while deltas: board.unplay(deltas.pop())
+        return BLACK if black > white else WHITE
+
+    # --- TÌM KIẾM ---
+    def search(self, board, player, time_limit, max_playouts=None):
+        """
+        Chạy UCT từ thế cờ board (player đi trước) tới khi hết giờ / đủ playout / bị hủy.
+        Trả về {(r, c): [visits, wins]} của các con ở gốc để gộp giữa nhiều process.
+        """
+        board = board.copy()
+        board.current_turn = player
+        opp_of = {BLACK: WHITE, WHITE: BLACK}
+        root = Node(None, opp_of[player], None, 0.0)
+        root.untried = self.expand_moves(board, player)
+        start = time.time(); self.playouts = 0
+        if not root.untried: return {}
+
+        while True:
+            if time.time() - start > time_limit: break
+            if max_playouts is not None and self.playouts >= max_playouts: break
+            if self.should_stop is not None and self.should_stop(): break
+
+            node = root; deltas = []
+            # 1. Selection
+            while not node.untried and node.children:
+                node = node.select_child()
+                deltas.append(board.play(node.move, node.color))
+            # 2. Expansion (mở nước có prior cao nhất còn lại)
+            if node.untried:
+                prior, move = node.untried.pop()
+                color = opp_of[node.color]
+                child = Node(move, color, node, prior)
+                node.children.append(child)
+                deltas.append(board.play(move, color))
+                child.untried = self.expand_moves(board, opp_of[color])
+                node = child
+            # 3. Simulation
+            winner = self.playout(board)
+            self.playouts += 1
+            # 4. Backpropagation
+            while node is not None:
+                node.visits += 1
+                if node.color == winner: node.wins += 1
+                node = node.parent
+            while deltas: board.unplay(deltas.pop())
+
+        return {child.move: [child.visits, child.wins] for child in root.children}
+
+def merge_root_stats(results):
+    """Gộp thống kê gốc của nhiều lượt tìm song song (root parallel): cộng visits/wins theo nước."""
+    merged = {}
+    for stats in results:
+        for move, (visits, wins) in stats.items():
+            entry = merged.setdefault(tuple(move), [0, 0.0])
+            entry[0] += visits; entry[1] += wins
+    return merged
+
+def best_from_stats(stats):
+    """Nước được thăm nhiều nhất (ổn định hơn chọn theo tỉ lệ thắng)."""
+    if not stats: return None, 0.0
+    move, (visits, wins) = max(stats.items(), key=lambda x: x[1][0])
+    return move, wins / visits if visits else 0.0
@@ -0,0 +1,85 @@
+import random
+from functools import lru_cache
+
+# Bàn cờ phẳng có viền: mỗi bên thêm 1 hàng/cột "ô viền" để khỏi phải
+# kiểm tra tọa độ hợp lệ trong các vòng lặp nóng.
+# Ô (r, c) nằm ở chỉ số p = (r + 1) * width + (c + 1), với width = size + 2.
+
+class BoardTables:
+    """Bảng tra cứu theo kích thước bàn cờ. Tính một lần, dùng chung (chỉ đọc)."""
+
+    def __init__(self, size):
+        self.size = size
+        self.width = size + 2
+        self.area = self.width * self.width
+        w = self.width
+
+        self.offsets = (-w, w, -1, 1)
+        self.diag_offsets = (-w - 1, -w + 1, w - 1, w + 1)
+
+        # Danh sách ô thật trên bàn (bỏ viền), theo thứ tự hàng
+        self.points = tuple(self.to_point(r, c) for r in range(size) for c in range(size))
+        self.on_board = bytearray(self.area)
+        for p in self.points: self.on_board[p] = 1
+
+        # Hàng xóm (4 hướng) và chéo của từng ô, chỉ gồm ô thật
+        self.neighbors = [()] * self.area
+        self.diagonals = [()] * self.area
+        for p in self.points:
+            self.neighbors[p] = tuple(p + d for d in self.offsets if self.on_board[p + d])
+            self.diagonals[p] = tuple(p + d for d in self.diag_offsets if self.on_board[p + d])
+
+        # Khoảng cách tới mép gần nhất (0 = dòng biên), -1 ở ô viền
+        self.edge_dist = [-1] * self.area
+        for p in self.points:
+            r, c = self.to_coord(p)
+            self.edge_dist[p] = min(r, c, size - 1 - r, size - 1 - c)
+
+        # Trọng số vị trí (heatmap): trung tâm 10, dòng 2 là 2, biên -2
+        self.position_weights = [0] * self.area
+        for p in self.points:
+            dist = self.edge_dist[p]
+            self.position_weights[p] = 10 if dist >= 2 else (2 if dist == 1 else -2)
+
+        # Ô trong cửa sổ 5x5 quanh mỗi ô (vùng sinh nước ứng viên của AI)
+        self.near = [()] * self.area
+        for p in self.points:
+            r, c = self.to_coord(p)
+            self.near[p] = tuple(self.to_point(r + dr, c + dc) for dr in range(-2, 3) for dc in range(-2, 3)
+                                 if 0 <= r + dr < size and 0 <= c + dc < size)
+
+        # Điểm sao dùng khi bàn còn trống: 4 góc dòng 3 + thiên nguyên
+        stars = []
+        for r, c in ((2, 2), (2, size - 3), (size - 3, 2), (size - 3, size - 3), (size // 2, size // 2)):
+            if 0 <= r < size and 0 <= c < size and self.to_point(r, c) not in stars:
+                stars.append(self.to_point(r, c))
+        self.star_points = tuple(stars)
+
+        # 8 phép đối xứng của bàn vuông (4 phép xoay x lật): symmetries[k][p] = ảnh của ô p
+        n = size - 1
+        transforms = (lambda r, c: (r, c), lambda r, c: (c, n - r), lambda r, c: (n - r, n - c),
+                      lambda r, c: (n - c, r), lambda r, c: (r, n - c), lambda r, c: (c, r),
+                      lambda r, c: (n - r, c), lambda r, c: (n - c, n - r))
+        self.symmetries = []
+        for f in transforms:
+            table = [0] * self.area
+            for p in self.points: table[p] = self.to_point(*f(*self.to_coord(p)))
+            self.symmetries.append(table)
+        self.inverse_symmetry = (0, 3, 2, 1, 4, 5, 6, 7) # Xoay 90 <-> xoay 270, còn lại tự nghịch đảo
+
+        # Khóa Zobrist 64-bit cho từng (giá trị ô, ô): 1 Đen, 2 Trắng, 3 Xác Đen, 4 Xác Trắng.
+        # Seed cố định theo size để mọi process/worker ra cùng 1 khóa cho cùng thế cờ.
+        rng = random.Random(0x5A0B ^ size)
+        self.zobrist = [None] + [[rng.getrandbits(64) for _ in range(self.area)] for _ in range(4)]
+        self.zobrist_turn = rng.getrandbits(64) # XOR vào khi tới lượt Trắng
+
+    def to_point(self, r, c):
+        return (r + 1) * self.width + c + 1
+
+    def to_coord(self, p):
+        r, c = divmod(p, self.width)
+        return r - 1, c - 1
+
+@lru_cache(maxsize=None)
+def get_tables(size):
+    return BoardTables(size)
@@ -0,0 +1,37 @@
+# Loại cận (bound) của điểm lưu trong bảng
+EXACT = 0
+LOWER = 1 # Điểm thật >= score (bị cắt beta)
+UPPER = 2 # Điểm thật <= score (không vượt được alpha)
+
+class TranspositionTable:
+    """
+    Bảng băm thế cờ có giới hạn cho minimax: mỗi ô giữ 1 entry
+    (key, depth, score, flag, best_move, generation).
+    Khi đụng ô: entry của lượt tìm cũ luôn bị thay, còn lại giữ entry sâu hơn.
+    """
+
+    def __init__(self, size_bits=18):
+        self.mask = (1 << size_bits) - 1
+        self.slots = [None] * (1 << size_bits)
+        self.generation = 0
+        self.hits = 0; self.stores = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    def clear(self):
+        self.slots = [None] * (self.mask + 1)
+
+    def get(self, key):
+        entry = self.slots[key & self.mask]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        return None
+
+    def put(self, key, depth, score, flag, move):
+        i = key & self.mask
+        old = self.slots[i]
+        if old is None or old[0] == key or old[5] != self.generation or depth >= old[1]:
+            self.slots[i] = (key, depth, score, flag, move, self.generation)
+            self.stores += 1
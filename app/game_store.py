@@ -0,0 +1,227 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from app.game_logic.board import GoBoard
+from app.game_journal import journal as default_journal, StaleGame
+
+# --- CẤU HÌNH ---
+GAME_TTL = float(os.environ.get("COVAY_GAME_TTL", 2 * 3600)) # Giây không đụng tới thì coi là bỏ ván
+MAX_GAMES = int(os.environ.get("COVAY_MAX_GAMES", 5000))
+MAX_GAME_BYTES = int(os.environ.get("COVAY_MAX_GAME_MB", 256)) * 1024 * 1024
+# Thư mục lưu ván bị đẩy ra (rỗng = bỏ luôn)
+SPILL_DIR = os.environ.get("COVAY_SPILL_DIR", "")
+SPILL_TTL = float(os.environ.get("COVAY_SPILL_TTL", 7 * 24 * 3600)) # File ván quá hạn này thì xóa
+SWEEP_INTERVAL = 60 # Chu kỳ quét ván hết hạn (giây)
+
+# Ước lượng bộ nhớ 1 ván (đo bằng tracemalloc): phần cố định theo số ô + mỗi nước trong history_stack
+BOARD_BASE_BYTES = 1500
+BYTES_PER_POINT = 28
+BYTES_PER_MOVE = 650
+
+def estimate_memory(board):
+    return BOARD_BASE_BYTES + BYTES_PER_POINT * board.size * board.size + BYTES_PER_MOVE * len(board.history_stack)
+
+class GameSession:
+    __slots__ = ('board', 'last_access', 'mem')
+
+    def __init__(self, board):
+        self.board = board
+        self.last_access = time.time()
+        self.mem = estimate_memory(board)
+
+class GameStore:
+    """
+    Sổ đăng ký ván PvE trong process: id ngẫu nhiên, thứ tự LRU theo lần truy cập,
+    đẩy ván ra khi rảnh quá TTL hoặc khi vượt giới hạn số ván / bộ nhớ ước lượng.
+    Ván bị đẩy ra được ghi gọn (export_moves) xuống SPILL_DIR nếu có, lần sau get() tự nạp lại.
+    Có journal thì mọi ván còn nằm trong DB: get() nạp lười theo id và đồng bộ nước do worker khác ghi,
+    không ghi file đổ ra nữa (trùng với nhật ký), sweep() xóa luôn nhật ký của ván rảnh quá TTL.
+    Được gọi từ threadpool (handler def, run_in_threadpool) nên mọi thao tác trên sessions / total_mem
+    giữ self.lock; đọc/ghi file và DB làm ngoài khóa.
+    """
+
+    def __init__(self, ttl=GAME_TTL, max_games=MAX_GAMES, max_bytes=MAX_GAME_BYTES, spill_dir=SPILL_DIR,
+                 spill_ttl=SPILL_TTL, journal=None):
+        self.journal = journal
+        self.ttl = ttl
+        self.spill_ttl = spill_ttl
+        self.max_games = max_games
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir if journal is None else "" # Có nhật ký thì khỏi ghi file trùng
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict() # gid -> GameSession, cũ nhất ở đầu
+        self.spilling = {} # gid -> board đã đẩy ra, đang chờ ghi file (get() lấy lại được ngay)
+        self.total_mem = 0
+        self.stats = {"created": 0, "evicted_idle": 0, "evicted_lru": 0, "spilled": 0, "restored": 0,
+                      "loaded": 0, "synced": 0, "reloaded": 0, "pruned": 0}
+        if self.spill_dir: os.makedirs(self.spill_dir, exist_ok=True)
+
+    def __contains__(self, gid):
+        return gid in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, size):
+        gid = uuid.uuid4().hex
+        board = GoBoard(size=size)
+        if self.journal is not None: self.journal.create(gid, board)
+        self._add(gid, board)
+        with self.lock: self.stats["created"] += 1
+        return gid
+
+    def get(self, gid):
+        """Board của ván gid (None nếu không có). Đánh dấu vừa truy cập."""
+        with self.lock:
+            session = self.sessions.get(gid)
+            if session is not None:
+                session.last_access = time.time()
+                self.sessions.move_to_end(gid)
+            elif gid in self.spilling: session = self._insert(gid, self.spilling.pop(gid))
+        if session is not None:
+            # Ván đã kết thúc ở worker này thì nhật ký đã xóa, không còn gì để đồng bộ
+            if self.journal is None or session.board.is_game_over or self._sync(gid, session.board): return session.board
+            self.drop(gid) # Bản RAM cũ hơn ảnh trong nhật ký: nạp lại bên dưới
+        board = self._restore(gid)
+        if board is not None and self.journal is not None and not self._sync(gid, board): board = None
+        if board is None:
+            board = self._load(gid)
+            if board is None: return None
+        return self._add(gid, board).board
+
+    def record(self, gid, board, kind):
+        """Ghi thao tác vừa làm vào nhật ký (nếu có) rồi touch(). StaleGame: bỏ bản RAM rồi ném tiếp."""
+        if self.journal is not None:
+            try: self.journal.append(gid, board, kind)
+            except StaleGame:
+                self.drop(gid); raise
+        self.touch(gid)
+
+    def drop(self, gid):
+        """Bỏ bản trong bộ nhớ (vd: lệch với nhật ký), lần get() sau nạp lại từ DB."""
+        with self.lock:
+            session = self.sessions.pop(gid, None)
+            if session is not None: self.total_mem -= session.mem
+
+    def _sync(self, gid, board):
+        """Áp nước worker khác đã ghi. False nếu nhật ký đã dọn qua version của board (phải nạp lại cả ván)."""
+        try: n = self.journal.sync(gid, board)
+        except StaleGame:
+            with self.lock: self.stats["reloaded"] += 1
+            return False
+        if n:
+            with self.lock: self.stats["synced"] += 1
+            self.touch(gid)
+        return True
+
+    def _load(self, gid):
+        if self.journal is None or len(gid) != 32 or not gid.isalnum(): return None
+        board = self.journal.load(gid)
+        if board is not None:
+            with self.lock: self.stats["loaded"] += 1
+        return board
+
+    def touch(self, gid):
+        """Gọi sau khi ván đổi (đánh, undo...): cập nhật ước lượng bộ nhớ rồi ép giới hạn."""
+        with self.lock:
+            session = self.sessions.get(gid)
+            if session is None: return
+            mem = estimate_memory(session.board)
+            self.total_mem += mem - session.mem; session.mem = mem
+            evicted = self._enforce_caps(keep=gid)
+        self._spill(evicted)
+
+    def sweep(self):
+        """Đẩy ra mọi ván rảnh quá TTL (duyệt từ đầu LRU, dừng ở ván còn mới). Có ghi file: chạy trong threadpool."""
+        cutoff = time.time() - self.ttl
+        evicted = []
+        with self.lock:
+            while self.sessions:
+                gid, session = next(iter(self.sessions.items()))
+                if session.last_access > cutoff: break
+                evicted.append(self._evict(gid)); self.stats["evicted_idle"] += 1
+            live = set(self.sessions)
+        self._spill(evicted)
+        if self.spill_dir: self._prune_spill()
+        if self.journal is not None:
+            # Cùng TTL với RAM; ván còn mở ở worker này thì giữ dù lâu không có nước mới
+            n = self.journal.prune(cutoff, keep=live)
+            with self.lock: self.stats["pruned"] += n
+
+    def _prune_spill(self):
+        cutoff = time.time() - self.spill_ttl
+        with os.scandir(self.spill_dir) as it:
+            for entry in it:
+                try:
+                    if entry.name.endswith(".moves") and entry.stat().st_mtime < cutoff: os.remove(entry.path)
+                except FileNotFoundError: pass # get() vừa nạp lại ván này
+
+    def _add(self, gid, board):
+        with self.lock:
+            # 2 luồng cùng nạp 1 ván: giữ bản vào trước
+            session = self.sessions.get(gid) or self._insert(gid, board)
+            evicted = self._enforce_caps(keep=gid)
+        self._spill(evicted)
+        return session
+
+    def _insert(self, gid, board):
+        session = GameSession(board)
+        self.sessions[gid] = session
+        self.total_mem += session.mem
+        return session
+
+    def _enforce_caps(self, keep=None):
+        """Giữ self.lock khi gọi. Trả về [(gid, board)] đã đẩy ra để _spill() ghi file ngoài khóa."""
+        evicted = []
+        while len(self.sessions) > 1 and (len(self.sessions) > self.max_games or self.total_mem > self.max_bytes):
+            gid = next(iter(self.sessions))
+            if gid == keep: break
+            evicted.append(self._evict(gid)); self.stats["evicted_lru"] += 1
+        return evicted
+
+    def _evict(self, gid):
+        session = self.sessions.pop(gid)
+        self.total_mem -= session.mem
+        if self.spill_dir: self.spilling[gid] = session.board
+        return gid, session.board
+
+    def _spill(self, evicted):
+        if not self.spill_dir or not evicted: return
+        for gid, board in evicted:
+            # Ghi file tạm rồi đổi tên: luồng khác không bao giờ đọc phải file ghi dở
+            path = self._spill_path(gid); tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f: f.write(board.export_moves())
+            with self.lock:
+                if self.spilling.get(gid) is board:
+                    os.replace(tmp, path); del self.spilling[gid]; self.stats["spilled"] += 1
+                else: os.remove(tmp) # get() đã lấy lại ván trong lúc ghi
+
+    def _restore(self, gid):
+        # gid do server sinh (uuid hex): không hợp lệ thì khỏi đụng tới đĩa
+        if not self.spill_dir or len(gid) != 32 or not gid.isalnum(): return None
+        path = self._spill_path(gid)
+        try:
+            with open(path, 'rb') as f: data = f.read()
+        except FileNotFoundError:
+            return None
+        try: os.remove(path)
+        except FileNotFoundError: pass # Luồng khác cũng vừa nạp file này: _add() giữ bản vào trước
+        with self.lock: self.stats["restored"] += 1
+        return GoBoard.from_moves(data)
+
+    def _spill_path(self, gid):
+        return os.path.join(self.spill_dir, f"{gid}.moves")
+
+    def snapshot_stats(self):
+        with self.lock:
+            s = dict(self.stats)
+            s["games"] = len(self.sessions)
+            s["memory_bytes"] = self.total_mem
+        s["max_games"] = self.max_games
+        s["max_bytes"] = self.max_bytes
+        return s
+
+games = GameStore(journal=default_journal)
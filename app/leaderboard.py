@@ -0,0 +1,102 @@
+import os
+import time
+from bisect import bisect_left, insort
+
+from sqlalchemy import select
+
+from app.models_db import AsyncSessionLocal, User
+from app.ranking_logic import get_rank_title
+
+# --- CẤU HÌNH ---
+# Nạp lại cả bảng từ DB sau mỗi N giây (gom thay đổi do worker khác ghi); 0 = không nạp lại
+LEADERBOARD_REFRESH = float(os.environ.get("COVAY_LEADERBOARD_REFRESH", 60))
+PAGE_LIMIT = 100 # Số dòng tối đa mỗi trang
+
+class Leaderboard:
+    """
+    Bảng xếp hạng trong RAM: danh sách khóa (-elo, id, username) luôn sắp tăng.
+    Đọc trang / tìm hạng = tìm nhị phân (O(log n)), cập nhật 1 người = bỏ khóa cũ + chèn khóa mới.
+    Mọi thao tác chạy trên event loop nên không cần khóa.
+    """
+
+    def __init__(self, refresh=LEADERBOARD_REFRESH):
+        self.refresh = refresh
+        self.keys = []
+        self.by_name = {} # username -> khóa hiện tại trong self.keys
+        self.loaded_at = 0.0
+        self.missed = None # Cập nhật xảy ra trong lúc load() đang chờ DB, áp lại sau khi đổi bảng
+        self.stats = {"reloads": 0, "updates": 0}
+
+    def __len__(self):
+        return len(self.keys)
+
+    async def load(self):
+        """Dựng lại từ DB (dùng index elo), đổi cả bảng 1 lần để người đọc không thấy bảng dở."""
+        self.missed = []
+        try:
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(select(User.elo, User.id, User.username).order_by(User.elo.desc(), User.id))).all()
+        except BaseException:
+            self.missed = None; raise
+        missed, self.missed = self.missed, None
+        self.keys = [(-elo, uid, name) for elo, uid, name in rows]
+        self.by_name = {k[2]: k for k in self.keys}
+        for args in missed: self.update(*args)
+        self.loaded_at = time.time(); self.stats["reloads"] += 1
+
+    def update(self, username, uid, elo):
+        """Gọi sau khi commit elo mới (finish, đăng ký)."""
+        if self.missed is not None: self.missed.append((username, uid, elo))
+        old = self.by_name.get(username)
+        if old is not None:
+            i = bisect_left(self.keys, old)
+            if i < len(self.keys) and self.keys[i] == old: del self.keys[i]
+        key = (-elo, uid, username)
+        insort(self.keys, key); self.by_name[username] = key
+        self.stats["updates"] += 1
+
+    def elo_of(self, username):
+        key = self.by_name.get(username)
+        return None if key is None else -key[0]
+
+    def rank_of_elo(self, elo):
+        """Hạng kiểu thi đấu: 1 + số người elo cao hơn hẳn (bằng elo thì cùng hạng)."""
+        return bisect_left(self.keys, (-elo,)) + 1
+
+    def entry(self, key):
+        elo = -key[0]
+        return {"username": key[2], "elo": elo, "rank": get_rank_title(elo), "position": self.rank_of_elo(elo)}
+
+    def top(self, limit=50):
+        return [self.entry(k) for k in self.keys[:limit]]
+
+    def page(self, cursor=None, limit=50):
+        """
+        Trang bắt đầu ngay sau cursor ("elo:id" của dòng cuối trang trước).
+        Cursor theo khóa nên không lệch khi có người lên/xuống hạng giữa 2 lần gọi (khác OFFSET).
+        """
+        limit = max(1, min(limit, PAGE_LIMIT))
+        start = 0
+        if cursor:
+            elo, uid = (int(x) for x in cursor.split(":"))
+            start = bisect_left(self.keys, (-elo, uid + 1)) # id là duy nhất: khóa đầu tiên sau (elo, id)
+        items = self.keys[start:start + limit]
+        nxt = f"{-items[-1][0]}:{items[-1][1]}" if items and start + limit < len(self.keys) else None
+        return {"items": [self.entry(k) for k in items], "next_cursor": nxt, "total": len(self.keys)}
+
+    def around(self, username, neighbors=5):
+        """Hạng của username + neighbors người ngay trên / dưới. None nếu không có."""
+        key = self.by_name.get(username)
+        if key is None: return None
+        i = bisect_left(self.keys, key)
+        lo = max(0, i - neighbors)
+        return {"me": self.entry(key),
+                "items": [self.entry(k) for k in self.keys[lo:i + neighbors + 1]], "total": len(self.keys)}
+
+    def snapshot_stats(self):
+        s = dict(self.stats)
+        s["users"] = len(self.keys)
+        s["age"] = round(time.time() - self.loaded_at, 1)
+        return s
+
+rankings = Leaderboard()
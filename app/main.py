@@ -1,144 +1,363 @@
-from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect
+import asyncio
+import json
+import uuid
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from app.models_db import create_tables, SessionLocal, User
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models_db import create_tables, get_db, async_engine, User, Match
 from app.game_logic.board import GoBoard
-from app.game_logic.ai import AIPlayer
-from app.auth_utils import get_password_hash, verify_password, create_access_token
+from app.engine_service import engine, EngineBusy, EngineCancelled, HINT_LEVEL
+from app.game_store import games, SWEEP_INTERVAL
+from app.game_journal import StaleGame, MOVE, PASS, UNDO
+from app.leaderboard import rankings
+from app.auth_utils import create_access_token, hash_pool, HashBusy, HashThrottled
 from app.socket_manager import manager
-from app.ranking_logic import calculate_elo_change, get_rank_title
+from app.ranking_logic import AI_ELO, apply_result, get_rank_title
 
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
-def get_db():
-    db = SessionLocal()
-    try: yield db
-    finally: db.close()
+FINISH_RETRIES = 5 # Số lần thử lại UPDATE elo khi bị request khác chen ngang
 
 # --- MODELS ---
 class UserReg(BaseModel): username: str; password: str; email: str
 class UserLog(BaseModel): username: str; password: str
 class MoveReq(BaseModel): row: int; col: int; player: int
 class AIMoveReq(BaseModel): difficulty: str = "hard"
-class FinishReq(BaseModel): winner_color: int; difficulty: str; opponent_elo: int = 1000
+class FinishReq(BaseModel):
+    winner_color: int; difficulty: str # "easy" / "medium" / "hard" / "mcts" (đấu AI) hoặc "online"
+    opponent: Optional[str] = None # Trận online: username đối thủ, Elo lấy từ DB
+    opponent_elo: Optional[int] = None # Cũ, server bỏ qua (client cũ vẫn gửi được)
+class AnalyzeReq(BaseModel):
+    game_id: Optional[str] = None # Phân tích ván đang có, hoặc gửi size + moves ([r, c] / null = bỏ lượt)
+    size: int = 19
+    moves: Optional[List[Optional[List[int]]]] = None
+    level: str = "hard"
+    time_per_move: float = 1.0
 # [MỚI] Model đổi mật khẩu
 class ChangePassReq(BaseModel): username: str; old_password: str; new_password: str
 
-games = {} 
+async def sweep_games():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        await run_in_threadpool(games.sweep) # Ghi file / DB: không chạy trên event loop
+
+async def refresh_rankings():
+    # Mỗi worker giữ bảng xếp hạng riêng: nạp lại định kỳ để thấy trận do worker khác ghi
+    while rankings.refresh:
+        await asyncio.sleep(rankings.refresh)
+        try: await rankings.load()
+        except Exception as e: print(f"[leaderboard] nạp lại lỗi: {e}")
 
 @app.on_event("startup")
-def startup(): create_tables()
+async def startup():
+    create_tables()
+    await run_in_threadpool(engine.start) # Chờ worker AI dựng xong, không chặn event loop
+    await rankings.load(); await manager.start()
+    asyncio.create_task(sweep_games()); asyncio.create_task(refresh_rankings())
+    asyncio.create_task(manager.matchmaker.run())
+
+@app.on_event("shutdown")
+async def shutdown():
+    engine.shutdown(); hash_pool.shutdown()
+    await manager.stop(); await async_engine.dispose()
+
+async def run_engine(request: Request, gid: str, board: GoBoard, player: int, level: str):
+    """Tìm nước qua engine (cache / process pool); hủy job nếu client ngắt kết nối."""
+    try:
+        res = await engine.search(gid, board, player, level, request.is_disconnected)
+    except EngineBusy:
+        raise HTTPException(503, "AI đang quá tải, thử lại sau")
+    except EngineCancelled:
+        raise HTTPException(409, "Lượt tính của AI đã bị hủy")
+    except asyncio.TimeoutError:
+        raise HTTPException(504, "AI quá thời gian")
+    # Job bị hủy/hết giờ ngay trong worker thì move=None không có nghĩa là AI muốn bỏ lượt
+    if res["aborted"]: raise HTTPException(504, "AI quá thời gian")
+    return res
+
+def board_state(board: GoBoard, since: Optional[int] = None, fmt: str = "grid"):
+    """
+    Trạng thái bàn cờ kèm version. Client gửi ?since=<version đang có> thì chỉ nhận các ô đổi
+    ("changes": [[r, c, giá trị]]); không dựng được delta thì trả cả bàn.
+    fmt=packed: cả bàn dạng chuỗi size*size ký tự thay cho grid lồng nhau.
+    """
+    if since is not None:
+        changes = board.changes_since(since)
+        if changes is not None: return {"version": board.version, "changes": changes}
+    if fmt == "packed": return {"version": board.version, "size": board.size, "packed": board.packed()}
+    return {"version": board.version, "grid": board.grid}
+
+def record(gid: str, board: GoBoard, kind: int):
+    """Ghi nhật ký ván; worker khác đã đi trước thì bản RAM bị bỏ, client tải lại thế cờ."""
+    try: games.record(gid, board, kind)
+    except StaleGame: raise HTTPException(409, "Thế cờ đã thay đổi")
+
+# Handler async không được chạm nhật ký (SQLite đồng bộ) ngay trên event loop: đẩy sang threadpool như handler def
+async def get_game(gid: str): return await run_in_threadpool(games.get, gid)
+async def record_async(gid: str, board: GoBoard, kind: int): await run_in_threadpool(record, gid, board, kind)
 
 # --- AUTH & USER ---
+async def find_user(db: AsyncSession, username: str):
+    return (await db.execute(select(User).where(User.username == username))).scalar_one_or_none()
+
+async def hashed(call):
+    """Chờ 1 lượt băm mật khẩu trên hash_pool (luồng riêng, không tranh threadpool với request game)."""
+    try: return await call
+    except HashBusy: raise HTTPException(503, "Máy chủ đang bận, thử lại sau", headers={"Retry-After": "1"})
+    except HashThrottled: raise HTTPException(429, "Thao tác quá nhanh, thử lại sau", headers={"Retry-After": "1"})
+
+def client_ip(request: Request):
+    return request.client.host if request.client else None
+
 @app.post("/auth/register")
-def register(u: UserReg, db: Session = Depends(get_db)):
-    if db.query(User).filter(User.username == u.username).first(): raise HTTPException(400, "User tồn tại")
-    new_user = User(username=u.username, hashed_password=get_password_hash(u.password), email=u.email, elo=1000)
-    db.add(new_user); db.commit()
+async def register(u: UserReg, request: Request, db: AsyncSession = Depends(get_db)):
+    if await find_user(db, u.username): raise HTTPException(400, "User tồn tại")
+    pw_hash = await hashed(hash_pool.hash(u.password, user=u.username, ip=client_ip(request)))
+    new_user = User(username=u.username, hashed_password=pw_hash, email=u.email, elo=1000)
+    db.add(new_user); await db.commit()
+    rankings.update(new_user.username, new_user.id, new_user.elo)
     return {"msg": "OK"}
 
 @app.post("/auth/login")
-def login(u: UserLog, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == u.username).first()
-    if not user or not verify_password(u.password, user.hashed_password): raise HTTPException(400, "Fail")
+async def login(u: UserLog, request: Request, db: AsyncSession = Depends(get_db)):
+    user = await find_user(db, u.username)
+    if not user: raise HTTPException(400, "Fail")
+    ok, new_hash = await hashed(hash_pool.verify(u.password, user.hashed_password, user=u.username, ip=client_ip(request)))
+    if not ok: raise HTTPException(400, "Fail")
+    # Hash cũ dùng tham số lỗi thời (vd: ít vòng hơn PBKDF2_ROUNDS): lưu hash mới luôn
+    if new_hash: user.hashed_password = new_hash; await db.commit()
     return {"access_token": create_access_token({"sub": user.username}), "username": user.username, "elo": user.elo, "rank": get_rank_title(user.elo)}
 
 # [MỚI] API ĐỔI MẬT KHẨU
 @app.post("/users/change_password")
-def change_password(req: ChangePassReq, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == req.username).first()
+async def change_password(req: ChangePassReq, request: Request, db: AsyncSession = Depends(get_db)):
+    user = await find_user(db, req.username)
     if not user: raise HTTPException(404, "User not found")
     
-    if not verify_password(req.old_password, user.hashed_password):
-        raise HTTPException(400, "Mật khẩu cũ không đúng")
+    ip = client_ip(request)
+    ok, _ = await hashed(hash_pool.verify(req.old_password, user.hashed_password, user=req.username, ip=ip))
+    if not ok: raise HTTPException(400, "Mật khẩu cũ không đúng")
     
-    user.hashed_password = get_password_hash(req.new_password)
-    db.commit()
+    user.hashed_password = await hashed(hash_pool.hash(req.new_password, user=req.username, ip=ip))
+    await db.commit()
     return {"msg": "Đổi mật khẩu thành công!"}
 
 @app.get("/users/{username}")
-def profile(username: str, db: Session = Depends(get_db)):
-    u = db.query(User).filter(User.username == username).first()
+async def profile(username: str, db: AsyncSession = Depends(get_db)):
+    u = await find_user(db, username)
     if not u: raise HTTPException(404)
     return {"username": u.username, "email": u.email, "elo": u.elo, "rank": get_rank_title(u.elo), "wins": u.wins, "losses": u.losses, "streak": u.current_streak}
 
 # --- GAME LOGIC (GIỮ NGUYÊN NHƯ CŨ) ---
 @app.post("/game/new/{size}")
 def new_game(size: int):
-    gid = "game_local"; games[gid] = GoBoard(size=size)
+    gid = games.create(size)
     return {"game_id": gid}
 
 @app.post("/game/{gid}/move")
-def move(gid: str, m: MoveReq):
-    if gid not in games: raise HTTPException(404)
-    board = games[gid]
+def move(gid: str, m: MoveReq, since: Optional[int] = None, fmt: str = "grid"):
+    board = games.get(gid)
+    if not board: raise HTTPException(404)
     suc, msg = board.make_move(m.row, m.col, m.player)
-    return {"msg": msg, "grid": board.grid, "captured": {"black": board.captured_black, "white": board.captured_white}, "game_over": False}
+    if suc: record(gid, board, MOVE)
+    return {"msg": msg, **board_state(board, since, fmt), "captured": {"black": board.captured_black, "white": board.captured_white}, "game_over": False}
 
 @app.post("/game/{gid}/ai_move")
-def ai_move(gid: str, req: AIMoveReq):
-    board = games.get(gid)
+async def ai_move(gid: str, req: AIMoveReq, request: Request, since: Optional[int] = None, fmt: str = "grid"):
+    board = await get_game(gid)
     if not board: raise HTTPException(404)
-    ai = AIPlayer(board.size, req.difficulty)
-    mv = ai.get_best_move(board, 2)
+    if board.is_game_over: raise HTTPException(409, "Game đã kết thúc")
+    if board.current_turn != 2: raise HTTPException(409, "Chưa tới lượt AI")
+    before = board.version
+    res = await run_engine(request, gid, board, 2, req.difficulty)
+    # Trong lúc AI nghĩ mà người chơi đã undo/đánh tiếp (hoặc ván bị đẩy ra) thì bỏ kết quả cũ
+    if await get_game(gid) is not board or board.version != before:
+        raise HTTPException(409, "Thế cờ đã thay đổi")
+    mv = tuple(res["move"]) if res["move"] else None
     if not mv:
-        is_over, msg = board.pass_turn()
+        is_over, msg = board.pass_turn(); await record_async(gid, board, PASS)
         if is_over:
             b, w = board.calculate_score()
-            return {"msg": "AI Bỏ lượt. Kết thúc!", "grid": board.grid, "game_over": True, "score": {"black": b, "white": w}}
-        return {"msg": "AI Pass", "grid": board.grid, "game_over": False}
-    board.make_move(mv[0], mv[1], 2)
-    return {"msg": "AI Move", "move": {"row": mv[0], "col": mv[1]}, "grid": board.grid}
+            return {"msg": "AI Bỏ lượt. Kết thúc!", **board_state(board, since, fmt), "game_over": True, "score": {"black": b, "white": w}}
+        return {"msg": "AI Pass", **board_state(board, since, fmt), "game_over": False}
+    ok, msg = board.make_move(mv[0], mv[1], 2)
+    if not ok: raise HTTPException(409, msg) # Nước bị từ chối: không ghi gì vào nhật ký
+    await record_async(gid, board, MOVE)
+    # Người đang nghĩ: tranh thủ worker rảnh tính trước gợi ý + nước đáp tiếp theo
+    engine.ponder(gid, board, 1, req.difficulty)
+    return {"msg": "AI Move", "move": {"row": mv[0], "col": mv[1]}, **board_state(board, since, fmt), "depth": res["depth"]}
 
 @app.post("/game/{gid}/pass")
-def pass_turn(gid: str):
-    if gid not in games: raise HTTPException(404)
-    board = games[gid]
-    is_over, msg = board.pass_turn()
+def pass_turn(gid: str, since: Optional[int] = None, fmt: str = "grid"):
+    board = games.get(gid)
+    if not board: raise HTTPException(404)
+    is_over, msg = board.pass_turn(); record(gid, board, PASS)
     if is_over:
         b, w = board.calculate_score()
-        return {"msg": msg, "grid": board.grid, "game_over": True, "score": {"black": b, "white": w}}
-    return {"msg": "Bạn đã Pass", "grid": board.grid, "game_over": False}
+        return {"msg": msg, **board_state(board, since, fmt), "game_over": True, "score": {"black": b, "white": w}}
+    return {"msg": "Bạn đã Pass", **board_state(board, since, fmt), "game_over": False}
 
 @app.post("/game/{gid}/hint")
-def get_hint(gid: str, req: MoveReq):
-    board = games.get(gid)
+async def get_hint(gid: str, req: MoveReq, request: Request):
+    board = await get_game(gid)
     if not board: return {"move": None}
-    ai = AIPlayer(board.size, "hard")
-    mv = ai.get_best_move(board, req.player)
-    return {"move": mv} 
+    res = await run_engine(request, gid, board, req.player, HINT_LEVEL)
+    return {"move": res["move"], "depth": res["depth"]} 
 
 @app.post("/game/{gid}/undo")
-def undo_move(gid: str):
-    if gid not in games: raise HTTPException(404)
-    board = games[gid]; board.undo_round()
-    return {"msg": "Undo", "grid": board.grid}
+async def undo_move(gid: str, since: Optional[int] = None, fmt: str = "grid"):
+    # async: cancel_game đụng job / future của engine, chỉ được gọi trên event loop
+    board = await get_game(gid)
+    if not board: raise HTTPException(404)
+    engine.cancel_game(gid)
+    if board.undo_round()[0]: await record_async(gid, board, UNDO)
+    return {"msg": "Undo", **board_state(board, since, fmt)}
+
+@app.get("/game/{gid}/score_estimate")
+def score_estimate(gid: str):
+    """Điểm tạm tính + chủ từng ô (chuỗi '0'/'1'/'2') để client vẽ lớp lãnh thổ sau mỗi nước."""
+    board = games.get(gid)
+    if not board: raise HTTPException(404)
+    return {"version": board.version, "size": board.size, **board.score_estimate()}
+
+MAX_ANALYSIS_MOVES = 600
+
+@app.post("/game/analyze")
+async def analyze_game(req: AnalyzeReq):
+    """
+    Phân tích cả ván: mỗi nước so với nước tốt nhất của engine, chạy song song trên process pool.
+    Trả NDJSON, mỗi dòng 1 nước theo thứ tự tính xong, dòng cuối {"done": true}.
+    """
+    if req.game_id:
+        board = await get_game(req.game_id)
+        if not board: raise HTTPException(404)
+        size = board.size; to_coord = board.tables.to_coord
+        moves = [(d.color, to_coord(d.point) if d.point else None) for d in board.history_stack]
+    else:
+        if not req.moves or not 2 <= req.size <= 25: raise HTTPException(400, "Thiếu size/moves")
+        size = req.size; moves = [(None, tuple(m) if m else None) for m in req.moves]
+    if len(moves) > MAX_ANALYSIS_MOVES: raise HTTPException(400, "Ván quá dài")
+    time_per_move = min(max(req.time_per_move, 0.2), 5.0)
+
+    # Dựng lại từng thế cờ trên 1 bàn duy nhất (đánh tiếp, không replay lại từ đầu)
+    replay = GoBoard(size); items = []; estimates = []
+    for i, (color, mv) in enumerate(moves):
+        if color is None: color = replay.current_turn
+        # Ván có undo: giống from_moves, đặt lại lượt / số lần bỏ lượt theo nước đã ghi
+        replay.current_turn = color
+        if replay.is_game_over: replay.consecutive_passes = 0; replay.is_game_over = False
+        items.append((i, replay.to_position(), color, mv))
+        if mv is None: replay.pass_turn()
+        else:
+            ok, msg = replay.make_move(mv[0], mv[1], color)
+            if not ok: raise HTTPException(400, f"Nước {i + 1} không hợp lệ: {msg}")
+        est = replay.score_estimate()
+        estimates.append({"black": est["black"], "white": est["white"]})
+
+    gid = f"analysis:{req.game_id or uuid.uuid4().hex}"
+
+    async def stream():
+        async for i, res in engine.analyze(gid, items, req.level, time_per_move):
+            color, mv = items[i][2], items[i][3]
+            line = {"index": i, "player": color, "move": mv, "estimate": estimates[i]}
+            if isinstance(res, Exception) or res["aborted"]:
+                line["error"] = "timeout" if not isinstance(res, Exception) else type(res).__name__
+            else:
+                best = tuple(res["best"]) if res["best"] else None
+                loss = None
+                if res["best_score"] is not None and res["move_score"] is not None:
+                    loss = res["best_score"] - res["move_score"]
+                line.update({"best": best, "match": best == mv, "best_score": res["best_score"],
+                             "move_score": res["move_score"], "loss": loss, "depth": res["depth"]})
+            yield json.dumps(line) + "\n"
+        yield json.dumps({"done": True, "moves": len(items)}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/game/{gid}/state")
+def game_state(gid: str, since: Optional[int] = None, fmt: str = "grid"):
+    board = games.get(gid)
+    if not board: raise HTTPException(404)
+    return {**board_state(board, since, fmt), "turn": board.current_turn, "game_over": board.is_game_over,
+            "captured": {"black": board.captured_black, "white": board.captured_white}}
 
 @app.post("/users/{username}/finish")
-def finish(username: str, req: FinishReq, db: Session = Depends(get_db)):
-    u = db.query(User).filter(User.username == username).first()
-    if not u: raise HTTPException(404)
-    
+async def finish(username: str, req: FinishReq, db: AsyncSession = Depends(get_db)):
     is_win = (req.winner_color == 1)
-    is_online = (req.difficulty == "online")
-    if is_win:
-        u.current_streak = u.current_streak + 1 if u.current_streak > 0 else 1
-        u.wins += 1
-    else:
-        u.current_streak = u.current_streak - 1 if u.current_streak < 0 else -1
-        u.losses += 1
-    gain, loss = calculate_elo_change(u.elo if is_win else req.opponent_elo, req.opponent_elo if is_win else u.elo, req.difficulty, u.current_streak if is_win else 0, u.current_streak if not is_win else 0, is_online)
-    delta = gain if is_win else -loss
-    u.elo = max(0, u.elo + delta)
-    db.commit()
-    return {"new_elo": u.elo, "delta": delta, "rank": get_rank_title(u.elo)}
+    difficulty = req.difficulty.lower()
+    if req.opponent_elo is not None: print(f"[finish] {username}: client gửi opponent_elo (đã bỏ, server không dùng)")
+    # Elo đối thủ chỉ lấy từ server: user đã đăng ký (online), Elo cố định của AI (PvE),
+    # trận online chưa gửi opponent thì coi đối thủ ngang Elo mình (không có thưởng chênh lệch)
+    opponent_id, opponent_elo = None, None
+    if difficulty == "online":
+        if req.opponent:
+            if req.opponent == username: raise HTTPException(400, "Đối thủ không hợp lệ")
+            opp = (await db.execute(select(User.id, User.elo).where(User.username == req.opponent))).one_or_none()
+            if not opp: raise HTTPException(404, "Không có đối thủ này")
+            opponent_id, opponent_elo = opp
+    else: opponent_elo = AI_ELO.get(difficulty, AI_ELO["hard"]) # Level lạ: như engine, coi là hard
+    # Cập nhật lạc quan: tính từ elo / chuỗi vừa đọc, UPDATE chỉ ăn nếu 2 giá trị đó chưa bị request khác đổi
+    for _ in range(FINISH_RETRIES):
+        u = (await db.execute(select(User.id, User.elo, User.current_streak).where(User.username == username))).one_or_none()
+        if not u: raise HTTPException(404)
+        opp_elo = u.elo if opponent_elo is None else opponent_elo
+        elo, streak, delta = apply_result(u.elo, u.current_streak, is_win, difficulty, opp_elo)
+        res = await db.execute(update(User)
+                               .where(User.id == u.id, User.elo == u.elo, User.current_streak == u.current_streak)
+                               .values(elo=elo, current_streak=streak,
+                                       wins=User.wins + int(is_win), losses=User.losses + int(not is_win)))
+        if res.rowcount == 1: break
+        await db.rollback()
+    else: raise HTTPException(409, "Kết quả đang được ghi, thử lại sau")
+    db.add(Match(user_id=u.id, opponent_id=opponent_id, difficulty=difficulty, is_win=is_win,
+                 opponent_elo=opp_elo, elo_before=u.elo, elo_after=elo, delta=delta))
+    await db.commit()
+    rankings.update(username, u.id, elo)
+    return {"new_elo": elo, "delta": delta, "rank": get_rank_title(elo)}
 
+@app.get("/users/{username}/matches")
+async def match_history(username: str, before: Optional[int] = None, limit: int = 20, db: AsyncSession = Depends(get_db)):
+    """Lịch sử trận mới nhất trước (before = id trận cuối của trang trước)."""
+    u = await find_user(db, username)
+    if not u: raise HTTPException(404)
+    q = select(Match).where(Match.user_id == u.id)
+    if before is not None: q = q.where(Match.id < before)
+    rows = (await db.execute(q.order_by(Match.id.desc()).limit(max(1, min(limit, 100))))).scalars().all()
+    return [{"id": m.id, "difficulty": m.difficulty, "win": m.is_win, "opponent_elo": m.opponent_elo,
+             "elo_before": m.elo_before, "elo_after": m.elo_after, "delta": m.delta, "played_at": m.played_at} for m in rows]
+
+@app.get("/engine/stats")
+def engine_stats(): return engine.snapshot_stats()
+
+@app.get("/auth/stats")
+async def auth_stats(): return hash_pool.snapshot_stats()
+
+@app.get("/game/stats")
+def game_stats(): return games.snapshot_stats()
+
+# Bảng xếp hạng phục vụ từ RAM (app/leaderboard.py), không đụng DB; async để chạy cùng luồng với update()
 @app.get("/leaderboard")
-def leaderboard(db: Session = Depends(get_db)):
-    users = db.query(User).order_by(User.elo.desc()).limit(50).all()
-    return [{"username": u.username, "elo": u.elo, "rank": get_rank_title(u.elo)} for u in users]
+async def leaderboard(): return rankings.top(50)
+
+@app.get("/leaderboard/page")
+async def leaderboard_page(cursor: Optional[str] = None, limit: int = 50):
+    try: return rankings.page(cursor, limit)
+    except ValueError: raise HTTPException(400, "Cursor không hợp lệ")
+
+@app.get("/leaderboard/rank/{username}")
+async def leaderboard_rank(username: str, neighbors: int = 5):
+    res = rankings.around(username, max(0, min(neighbors, 50)))
+    if res is None: raise HTTPException(404)
+    return res
+
+@app.get("/leaderboard/stats")
+async def leaderboard_stats(): return rankings.snapshot_stats()
 
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
@@ -146,6 +365,19 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
     try:
         while True:
             data = await websocket.receive_json()
-            if data['type'] == 'find_match': await manager.add_to_queue(websocket, data['size'], data['user'])
+            if data['type'] == 'find_match':
+                # Elo lấy từ bảng xếp hạng trong RAM (client không tự khai được); khách chưa đăng ký = 1000
+                user = data['user']
+                elo = rankings.elo_of(user.get('username')) if isinstance(user, dict) else None
+                await manager.add_to_queue(websocket, data['size'], user, elo if elo is not None else 1000)
             elif data['type'] == 'move': await manager.broadcast_move(data['game_id'], data, websocket)
-    except WebSocketDisconnect: manager.disconnect(websocket)
\ No newline at end of file
+            elif data['type'] == 'spectate': manager.spectate(websocket, data['game_id'])
+            elif data['type'] == 'unspectate': manager.unspectate(websocket)
+    except WebSocketDisconnect: pass
+    finally: manager.disconnect(websocket)
+
+@app.get("/ws/stats")
+async def ws_stats(): return manager.snapshot_stats()
+
+@app.get("/matchmaking/stats")
+async def matchmaking_stats(): return manager.matchmaking_stats()
\ No newline at end of file
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+
+# --- CẤU HÌNH ---
+BUCKET_WIDTH = int(os.environ.get("COVAY_MM_BUCKET", 100)) # Độ rộng 1 ngăn Elo
+BASE_WINDOW = int(os.environ.get("COVAY_MM_WINDOW", 50)) # Chênh Elo chấp nhận lúc mới vào hàng
+WIDEN_PER_SEC = float(os.environ.get("COVAY_MM_WIDEN", 10)) # Mỗi giây chờ nới thêm bấy nhiêu Elo
+MAX_WINDOW = int(os.environ.get("COVAY_MM_MAX_WINDOW", 800))
+TICK_INTERVAL = float(os.environ.get("COVAY_MM_TICK", 0.5)) # Ghép theo lô mỗi N giây
+RECENT_MATCHES = 500 # Số trận gần nhất giữ lại để tính phân vị thời gian chờ / chênh Elo
+
+class Ticket:
+    __slots__ = ('key', 'size', 'elo', 'seq', 'user_info', 'since')
+
+    def __init__(self, key, size, elo, seq, user_info, since=None):
+        self.key = key
+        self.size = size
+        self.elo = elo
+        self.seq = seq
+        self.user_info = user_info
+        self.since = since or time.time()
+
+    def window(self, now):
+        return min(MAX_WINDOW, BASE_WINDOW + WIDEN_PER_SEC * (now - self.since))
+
+def percentile(values, q):
+    if not values: return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class Matchmaker:
+    """
+    Hàng chờ online theo (cỡ bàn, ngăn Elo): mỗi ngăn là list (elo, seq) sắp tăng, tìm / thêm / bớt bằng bisect.
+    Mỗi tick duyệt người chờ lâu nhất trước, ghép với người gần Elo nhất mà cả 2 bên còn chấp nhận;
+    cửa sổ Elo của mỗi người nới dần theo thời gian chờ nên không ai phải đợi mãi.
+    on_match(ticket_đen, ticket_trắng) do ConnectionManager truyền vào (người chờ lâu hơn cầm Đen).
+    """
+
+    def __init__(self, sizes, on_match):
+        self.on_match = on_match
+        self.buckets = {size: {} for size in sizes} # size -> {ngăn: [(elo, seq), ...]}
+        self.waiting = {size: OrderedDict() for size in sizes} # size -> {seq: Ticket}, chờ lâu nhất ở đầu
+        self.tickets = {} # khóa người chơi (id kết nối) -> Ticket
+        self.seq = 0
+        self.recent = deque(maxlen=RECENT_MATCHES) # (giây chờ của người chờ lâu hơn, chênh Elo)
+        self.stats = {"enqueued": 0, "cancelled": 0, "matched": 0, "ticks": 0, "total_wait": 0.0, "total_diff": 0}
+
+    def clear(self):
+        """Bỏ mọi phiếu đang chờ (mất quyền leader). Giữ nguyên object để vòng run() đang chạy vẫn tick đúng hàng."""
+        for buckets in self.buckets.values(): buckets.clear()
+        for waiting in self.waiting.values(): waiting.clear()
+        self.tickets.clear()
+
+    def __contains__(self, key):
+        return key in self.tickets
+
+    def enqueue(self, key, size, elo, user_info, since=None):
+        """
+        Vào hàng chờ (đang chờ ở hàng khác thì chuyển sang). False nếu không hỗ trợ cỡ bàn này.
+        since: lúc bắt đầu chờ (gửi lại sau khi đổi leader thì không mất thời gian đã chờ).
+        """
+        if size not in self.waiting: return False
+        self.cancel(key)
+        self.seq += 1
+        t = Ticket(key, size, int(elo), self.seq, user_info, since)
+        self.tickets[key] = t
+        self.waiting[size][t.seq] = t
+        insort(self.buckets[size].setdefault(t.elo // BUCKET_WIDTH, []), (t.elo, t.seq))
+        self.stats["enqueued"] += 1
+        return True
+
+    def cancel(self, key):
+        t = self.tickets.get(key)
+        if t is None: return
+        self._remove(t); self.stats["cancelled"] += 1
+
+    def _remove(self, t):
+        del self.tickets[t.key]
+        del self.waiting[t.size][t.seq]
+        b = t.elo // BUCKET_WIDTH
+        lst = self.buckets[t.size][b]
+        del lst[bisect_left(lst, (t.elo, t.seq))]
+        if not lst: del self.buckets[t.size][b]
+
+    def _nearest(self, t, window):
+        """Người chờ khác gần Elo của t nhất, trong phạm vi window (chỉ xét các ngăn phủ cửa sổ)."""
+        buckets = self.buckets[t.size]; waiting = self.waiting[t.size]
+        best = None
+        for b in range(int(t.elo - window) // BUCKET_WIDTH, int(t.elo + window) // BUCKET_WIDTH + 1):
+            lst = buckets.get(b)
+            if not lst: continue
+            i = bisect_left(lst, (t.elo, t.seq))
+            # Gần nhất trong ngăn nằm ngay quanh vị trí chèn (bỏ qua chính t)
+            for j in (i - 1, i, i + 1):
+                if 0 <= j < len(lst) and lst[j][1] != t.seq:
+                    diff = abs(lst[j][0] - t.elo)
+                    if diff <= window and (best is None or diff < best[0]): best = (diff, lst[j][1])
+        return None if best is None else waiting[best[1]]
+
+    def tick(self):
+        """1 lượt ghép theo lô. Trả về số cặp đã ghép."""
+        now = time.time(); pairs = 0
+        self.stats["ticks"] += 1
+        for size, waiting in self.waiting.items():
+            if len(waiting) < 2: continue
+            for seq in list(waiting):
+                t = waiting.get(seq)
+                if t is None: continue # Đã được ghép ở vòng trước trong tick này
+                o = self._nearest(t, t.window(now))
+                if o is None or abs(o.elo - t.elo) > o.window(now): continue
+                self._remove(t); self._remove(o)
+                wait = now - t.since; diff = abs(o.elo - t.elo)
+                self.recent.append((wait, diff))
+                self.stats["matched"] += 1; self.stats["total_wait"] += wait; self.stats["total_diff"] += diff
+                pairs += 1
+                self.on_match(*((t, o) if t.seq < o.seq else (o, t)))
+        return pairs
+
+    async def run(self, interval=TICK_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try: self.tick()
+            except Exception as e: print(f"[matchmaking] tick lỗi: {e}")
+
+    def snapshot_stats(self):
+        s = dict(self.stats)
+        n = max(1, s["matched"])
+        s["avg_wait"] = round(s.pop("total_wait") / n, 2)
+        s["avg_elo_diff"] = round(s.pop("total_diff") / n, 1)
+        waits = [w for w, _ in self.recent]; diffs = [d for _, d in self.recent]
+        s["recent_wait_p50"] = round(percentile(waits, 0.5), 2); s["recent_wait_p90"] = round(percentile(waits, 0.9), 2)
+        s["recent_diff_p50"] = percentile(diffs, 0.5); s["recent_diff_p90"] = percentile(diffs, 0.9)
+        now = time.time()
+        s["waiting"] = {size: len(w) for size, w in self.waiting.items()}
+        s["oldest_wait"] = {size: round(now - next(iter(w.values())).since, 1) if w else 0 for size, w in self.waiting.items()}
+        return s
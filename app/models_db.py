@@ -1,14 +1,48 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from sqlalchemy import create_engine, event, Column, Integer, String, DateTime, Boolean, LargeBinary, SmallInteger, ForeignKey, UniqueConstraint
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import datetime
+import os
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./covay.db"
+# --- CẤU HÌNH ---
+SQLALCHEMY_DATABASE_URL = os.environ.get("COVAY_DATABASE_URL", "sqlite:///./covay.db")
+# Bản async của cùng DB (mặc định: SQLite qua aiosqlite)
+ASYNC_DATABASE_URL = os.environ.get("COVAY_ASYNC_DATABASE_URL", SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1))
+DB_POOL_SIZE = int(os.environ.get("COVAY_DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("COVAY_DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("COVAY_DB_POOL_TIMEOUT", 10)) # Giây chờ lấy kết nối trước khi báo lỗi
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("COVAY_DB_BUSY_TIMEOUT_MS", 5000)) # SQLite: chờ khóa ghi thay vì lỗi "database is locked"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+pool_args = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT, "pool_pre_ping": not IS_SQLITE}
+
+# Engine đồng bộ: nhật ký ván (game_journal), tool offline, create_tables
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False} if IS_SQLITE else {}, **pool_args)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Engine async: các endpoint user/leaderboard, không chặn event loop khi chờ DB
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_args)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+def set_sqlite_pragmas(dbapi_conn, _record):
+    """
+    WAL: người đọc không chặn người ghi (và ngược lại), 2 engine + nhiều worker dùng chung file được.
+    synchronous=NORMAL an toàn với WAL, chỉ fsync lúc checkpoint thay vì mỗi commit.
+    """
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    cur.execute("PRAGMA cache_size=-16000") # ~16MB page cache mỗi kết nối
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA foreign_keys=ON")
+    cur.close()
+
+if IS_SQLITE:
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
@@ -16,12 +50,57 @@ class User(Base):
     email = Column(String(100), unique=True, index=True, nullable=True)
     hashed_password = Column(String(255), nullable=False)
     
-    elo = Column(Integer, default=1000) # Mặc định 1000 để leo rank cho sướng
+    elo = Column(Integer, default=1000, index=True) # Mặc định 1000 để leo rank cho sướng
     wins = Column(Integer, default=0)
     losses = Column(Integer, default=0)
     current_streak = Column(Integer, default=0) # + là chuỗi thắng, - là chuỗi thua
     
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+# --- LỊCH SỬ TRẬN (XẾP HẠNG) ---
+class Match(Base):
+    """
+    1 dòng / 1 lần /users/{username}/finish (trận online: mỗi người chơi 1 dòng theo góc nhìn của mình).
+    Thứ tự id = thứ tự thời gian: tool tính lại Elo duyệt theo id.
+    """
+    __tablename__ = "matches"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
+    opponent_id = Column(Integer, ForeignKey("users.id"), nullable=True) # Chỉ trận online có đối thủ là user
+    difficulty = Column(String(16), nullable=False) # easy / medium / hard / mcts / online
+    is_win = Column(Boolean, nullable=False)
+    opponent_elo = Column(Integer, nullable=False) # Elo đối thủ dùng để tính (của user thật nếu có opponent_id)
+    elo_before = Column(Integer, nullable=False)
+    elo_after = Column(Integer, nullable=False)
+    delta = Column(Integer, nullable=False)
+    played_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# --- NHẬT KÝ VÁN CỜ ---
+class GameMove(Base):
+    """1 dòng / 1 thao tác trên ván (đánh, bỏ lượt, undo), seq = board.version sau thao tác."""
+    __tablename__ = "game_moves"
+    __table_args__ = (UniqueConstraint("game_id", "seq"),) # 2 worker ghi trùng seq -> 1 bên lỗi
+    id = Column(Integer, primary_key=True)
+    game_id = Column(String(32), index=True, nullable=False)
+    seq = Column(Integer, nullable=False)
+    kind = Column(SmallInteger, nullable=False) # 0 đánh, 1 bỏ lượt, 2 undo
+    code = Column(Integer, default=0) # màu << 12 | ô phẳng (như export_moves)
+
+class GameSnapshot(Base):
+    """Ảnh gọn mới nhất của ván (GoBoard.export_moves) tại seq; nạp lại = ảnh + các dòng sau seq."""
+    __tablename__ = "game_snapshots"
+    game_id = Column(String(32), primary_key=True)
+    seq = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    # Lần ghi cuối vào nhật ký ván (GameStore.sweep xóa ván rảnh quá GAME_TTL theo cột này)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+
 def create_tables():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    # create_all bỏ qua bảng đã có: index thêm sau (vd: users.elo) phải tạo riêng trên DB cũ
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes: index.create(bind=engine, checkfirst=True)
+
+async def get_db():
+    """Dependency FastAPI: 1 AsyncSession mỗi request."""
+    async with AsyncSessionLocal() as db: yield db
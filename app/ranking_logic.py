@@ -1,3 +1,6 @@
+# Elo cố định của AI theo độ khó: ván PvE lấy Elo đối thủ ở đây, không tin số client gửi
+AI_ELO = {"easy": 800, "medium": 1100, "hard": 1400, "mcts": 1600}
+
 def get_rank_title(elo):
     if elo < 1000: return "Iron"
     if elo < 1200: return "Bronze"
@@ -10,7 +13,7 @@ def calculate_elo_change(winner_elo, loser_elo, difficulty, winner_streak, loser
     Tính điểm ELO theo luật:
     - PvE Easy: +5/-10 (No Streak)
     - PvE Medium: +10/-10
-    - PvE Hard: +20/-15
+    - PvE Hard / MCTS: +20/-15
     - Online: Base(+25/-20) + Streak Bonus + Diff Bonus - High Elo Penalty
     """
     base_gain = 0
@@ -24,7 +27,7 @@ def calculate_elo_change(winner_elo, loser_elo, difficulty, winner_streak, loser
             base_gain = 5; base_loss = 10
         elif difficulty == "medium":
             base_gain = 10; base_loss = 10
-        else: # hard
+        else: # hard, mcts
             base_gain = 20; base_loss = 15
 
     # 2. Bonus Chuỗi thắng (Chỉ Online hoặc PvE không phải Easy)
@@ -60,4 +63,17 @@ def calculate_elo_change(winner_elo, loser_elo, difficulty, winner_streak, loser
     
     total_loss = base_loss + streak_penalty
 
-    return total_gain, total_loss
\ No newline at end of file
+    return total_gain, total_loss
+
+def apply_result(elo, streak, is_win, difficulty, opponent_elo):
+    """
+    Kết quả 1 ván của 1 người chơi: (elo mới, chuỗi mới, delta).
+    Dùng chung cho /users/{username}/finish và tool tính lại toàn bộ (app/tools/recompute_ratings.py).
+    """
+    is_online = (difficulty == "online")
+    if is_win: streak = streak + 1 if streak > 0 else 1
+    else: streak = streak - 1 if streak < 0 else -1
+    gain, loss = calculate_elo_change(elo if is_win else opponent_elo, opponent_elo if is_win else elo, difficulty,
+                                      streak if is_win else 0, streak if not is_win else 0, is_online)
+    delta = gain if is_win else -loss
+    return max(0, elo + delta), streak, delta
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import os
+import uuid
+
+# Redis là tùy chọn: chỉ cần khi COVAY_REALTIME=redis://...
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+# flock chỉ có trên Unix (Windows không có fcntl): thiếu thì COVAY_REALTIME=unix:... chạy như local
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# --- CẤU HÌNH ---
+# "local" (1 worker), "unix:/đường/dẫn.sock" (nhiều worker cùng máy), "redis://host:6379/0" (nhiều máy)
+REALTIME_URL = os.environ.get("COVAY_REALTIME", "local")
+LEADER_TTL = 5.0 # Redis: giây giữ quyền leader ghép trận nếu không gia hạn
+RECONNECT_DELAY = 0.2
+
+WORKER_ID = uuid.uuid4().hex[:12] # Định danh worker này trên kênh "w:<id>"
+
+class LocalBackend:
+    """
+    Pub/sub trong 1 process. Mọi backend cùng giao diện:
+    start(handler, channels, on_leader, on_reconnect) / subscribe / unsubscribe / publish (không chặn) / stop.
+    handler(kênh, chuỗi) nhận mọi tin publish lên kênh đã subscribe (kể cả tin do chính worker này gửi).
+    on_leader(True/False): worker được / mất quyền chạy ghép trận (chỉ 1 worker giữ quyền tại 1 thời điểm).
+    on_reconnect(): vừa nối lại sau khi mất kết nối (tin trong lúc mất có thể đã rơi).
+    """
+
+    def __init__(self):
+        self.handler = None
+        self.on_leader = None
+        self.on_reconnect = None
+        self.channels = set()
+        self.is_leader = False
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0, "reconnects": 0}
+
+    async def start(self, handler, channels=(), on_leader=None, on_reconnect=None):
+        self.handler = handler; self.channels.update(channels)
+        self.is_leader = True
+        if on_leader: on_leader(True)
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+
+    def unsubscribe(self, channel):
+        self.channels.discard(channel)
+
+    def publish(self, channel, message):
+        self.stats["published"] += 1
+        if channel in self.channels:
+            asyncio.get_running_loop().call_soon(self._deliver, channel, message)
+
+    def _deliver(self, channel, message):
+        if channel not in self.channels: return
+        self.stats["delivered"] += 1
+        self.handler(channel, message)
+
+    async def stop(self):
+        self.channels.clear()
+
+    def snapshot_stats(self):
+        return {"backend": type(self).__name__, "worker": WORKER_ID, "leader": self.is_leader,
+                "channels": len(self.channels), **self.stats}
+
+class UnixSocketBackend(LocalBackend):
+    """
+    Nhiều worker uvicorn trên cùng máy: worker đầu tiên giữ được flock trên <path>.lock làm hub
+    (mở Unix socket, chuyển tin theo kênh), các worker khác nối vào hub. Hub chết thì flock tự nhả,
+    1 worker khác lên thay, các worker còn lại nối lại và gửi lại danh sách kênh.
+    Khung tin: 1 dòng JSON {"op": "sub"/"unsub"/"pub", "ch": kênh, "msg": chuỗi}.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.lock_fd = None
+        self.server = None
+        self.peers = {} # hub: writer -> set kênh của worker đó
+        self.writer = None # worker thường: kết nối tới hub
+        self.task = None
+
+    async def start(self, handler, channels=(), on_leader=None, on_reconnect=None):
+        self.handler = handler; self.channels.update(channels)
+        self.on_leader = on_leader; self.on_reconnect = on_reconnect
+        connected = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self._run(connected))
+        await connected
+
+    async def _run(self, connected):
+        while True:
+            if self._try_lock():
+                await self._serve()
+                if not connected.done(): connected.set_result(None)
+                return
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(RECONNECT_DELAY); continue # Hub đang khởi động
+            self.writer = writer
+            for ch in self.channels: self._send(writer, {"op": "sub", "ch": ch})
+            if not connected.done(): connected.set_result(None)
+            else:
+                self.stats["reconnects"] += 1
+                if self.on_reconnect: self.on_reconnect()
+            try:
+                while line := await reader.readline():
+                    frame = json.loads(line)
+                    self._deliver(frame["ch"], frame["msg"])
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            self.writer = None
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def _try_lock(self):
+        if self.lock_fd is None: self.lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try: fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError: return False
+        return True
+
+    async def _serve(self):
+        # Đã giữ flock: file socket còn lại (nếu có) là của hub cũ đã chết
+        if os.path.exists(self.path): os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._peer, self.path)
+        self.is_leader = True
+        if self.on_leader: self.on_leader(True)
+
+    async def _peer(self, reader, writer):
+        subs = self.peers[writer] = set()
+        try:
+            while line := await reader.readline():
+                frame = json.loads(line)
+                op = frame["op"]
+                if op == "pub": self._route(frame["ch"], frame["msg"])
+                elif op == "sub": subs.add(frame["ch"])
+                else: subs.discard(frame["ch"])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self.peers[writer]; writer.close()
+
+    def _route(self, channel, message):
+        """Hub: giao tin cho hub (nếu có kênh) và mọi worker đã subscribe kênh."""
+        if channel in self.channels: asyncio.get_running_loop().call_soon(self._deliver, channel, message)
+        line = None
+        for writer, subs in self.peers.items():
+            if channel in subs:
+                if line is None: line = (json.dumps({"ch": channel, "msg": message}) + "\n").encode()
+                writer.write(line)
+
+    @staticmethod
+    def _send(writer, frame):
+        writer.write((json.dumps(frame) + "\n").encode())
+
+    def subscribe(self, channel):
+        if channel in self.channels: return
+        self.channels.add(channel)
+        if self.writer is not None: self._send(self.writer, {"op": "sub", "ch": channel})
+
+    def unsubscribe(self, channel):
+        if channel not in self.channels: return
+        self.channels.discard(channel)
+        if self.writer is not None: self._send(self.writer, {"op": "unsub", "ch": channel})
+
+    def publish(self, channel, message):
+        self.stats["published"] += 1
+        if self.server is not None: self._route(channel, message)
+        elif self.writer is not None: self._send(self.writer, {"op": "pub", "ch": channel, "msg": message})
+        else: self.stats["dropped"] += 1 # Đang nối lại hub
+
+    async def stop(self):
+        if self.task: self.task.cancel()
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.peers): writer.close()
+            if os.path.exists(self.path): os.unlink(self.path)
+        if self.writer is not None: self.writer.close()
+        if self.lock_fd is not None: os.close(self.lock_fd) # Nhả flock
+
+class RedisBackend(LocalBackend):
+    """
+    Nhiều máy: kênh = Redis pub/sub (tiền tố "covay:"), quyền leader ghép trận = khóa SET NX có hạn LEADER_TTL,
+    leader gia hạn định kỳ; leader chết thì worker khác giành khóa sau tối đa LEADER_TTL giây.
+    """
+    PREFIX = "covay:"
+    RENEW = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+
+    def __init__(self, url):
+        super().__init__()
+        if aioredis is None: raise RuntimeError("COVAY_REALTIME=redis cần cài gói redis (pip install redis)")
+        self.redis = aioredis.from_url(url)
+        self.pubsub = self.redis.pubsub()
+        self.tasks = []
+
+    async def start(self, handler, channels=(), on_leader=None, on_reconnect=None):
+        self.handler = handler; self.on_leader = on_leader; self.on_reconnect = on_reconnect
+        self.channels.update(channels)
+        await self.pubsub.subscribe(*[self.PREFIX + ch for ch in self.channels])
+        self.tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._elect())]
+
+    async def _listen(self):
+        n = len(self.PREFIX)
+        async for item in self.pubsub.listen():
+            if item["type"] != "message": continue
+            self._deliver(item["channel"].decode()[n:], item["data"].decode())
+
+    async def _elect(self):
+        key = self.PREFIX + "leader"; ttl = int(LEADER_TTL * 1000)
+        while True:
+            try:
+                if self.is_leader: held = await self.redis.eval(self.RENEW, 1, key, WORKER_ID, ttl)
+                else: held = await self.redis.set(key, WORKER_ID, nx=True, px=ttl)
+            except Exception as e:
+                print(f"[realtime] redis lỗi: {e}"); held = False
+            if bool(held) != self.is_leader:
+                self.is_leader = bool(held)
+                if self.on_leader: self.on_leader(self.is_leader)
+            await asyncio.sleep(LEADER_TTL / 3)
+
+    def subscribe(self, channel):
+        if channel in self.channels: return
+        self.channels.add(channel)
+        asyncio.create_task(self.pubsub.subscribe(self.PREFIX + channel))
+
+    def unsubscribe(self, channel):
+        if channel not in self.channels: return
+        self.channels.discard(channel)
+        asyncio.create_task(self.pubsub.unsubscribe(self.PREFIX + channel))
+
+    def publish(self, channel, message):
+        self.stats["published"] += 1
+        asyncio.create_task(self.redis.publish(self.PREFIX + channel, message))
+
+    async def stop(self):
+        for t in self.tasks: t.cancel()
+        if self.is_leader and await self.redis.get(self.PREFIX + "leader") == WORKER_ID.encode():
+            await self.redis.delete(self.PREFIX + "leader")
+        await self.pubsub.close(); await self.redis.close()
+
+def create_backend(url=REALTIME_URL):
+    if url.startswith("unix:"):
+        if fcntl is not None and hasattr(asyncio, "start_unix_server"): return UnixSocketBackend(url[5:])
+        print("[realtime] máy này không hỗ trợ Unix socket / flock, dùng backend local (1 worker)")
+        return LocalBackend()
+    if url.startswith(("redis://", "rediss://")): return RedisBackend(url)
+    return LocalBackend()
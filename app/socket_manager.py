@@ -1,45 +1,370 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import deque
 from fastapi import WebSocket
+from app.matchmaking import Matchmaker
+from app.realtime import create_backend, WORKER_ID
+
+# --- CẤU HÌNH ---
+SEND_QUEUE_MAX = int(os.environ.get("COVAY_WS_QUEUE", 64)) # Số tin chờ gửi tối đa mỗi socket
+SEND_TIMEOUT = float(os.environ.get("COVAY_WS_SEND_TIMEOUT", 10)) # 1 lần gửi quá lâu = client chết / quá chậm
+# Hàng đợi gửi đầy: "close" đóng socket chậm (client nối lại rồi tải thế cờ), "drop_oldest" bỏ tin cũ nhất
+OVERFLOW_POLICY = os.environ.get("COVAY_WS_OVERFLOW", "close")
+BOARD_SIZES = (9, 13, 19)
+SNAPSHOT_TIMEOUT = 3.0 # Giây chờ worker có trận trả snapshot cho người xem; quá thì coi như không có trận
+
+# Kênh pub/sub (app/realtime.py): "mm" hàng chờ (chỉ leader nghe), "w:<worker>" tin riêng cho 1 worker,
+# "g:<game_id>" nước đi của 1 trận (worker có người chơi trận đó nghe), "all" mọi worker
+MM_CHANNEL = "mm"
+ALL_CHANNEL = "all"
+
+class Client:
+    """1 socket đang mở: hàng đợi gửi riêng + task ghi chỉ sống khi còn tin (socket rảnh không tốn task)."""
+    __slots__ = ('ws', 'cid', 'outbox', 'writer', 'game_id', 'waiting', 'watching', 'closed')
+
+    def __init__(self, ws, cid):
+        self.ws = ws
+        self.cid = cid # "<worker>:<số>", định danh toàn cụm
+        self.outbox = deque()
+        self.writer = None
+        self.game_id = None
+        self.waiting = None # Phiếu xếp hàng đã gửi leader (gửi lại nếu đổi leader)
+        self.watching = None # game_id đang xem
+        self.closed = False
+
+class GameChannel:
+    """
+    1 trận online mà worker này đang nghe kênh "g:<id>": người chơi / người xem ở worker này + nhật ký nước đi
+    (chuỗi JSON đúng như người chơi gửi, theo thứ tự backend giao - mọi worker thấy cùng 1 thứ tự).
+    Worker chỉ có người xem thì chưa có nhật ký (ready=False): xin snapshot từ worker có người chơi,
+    nước đến trong lúc chờ giữ ở pending, nhận snapshot xong thì áp các nước chưa có (theo id nước).
+    """
+    __slots__ = ('game_id', 'players', 'watchers', 'moves', 'ids', 'ready', 'pending', 'snapshot')
+
+    def __init__(self, game_id, ready):
+        self.game_id = game_id
+        self.players = set()
+        self.watchers = set()
+        self.moves = []
+        self.ids = []
+        self.ready = ready
+        self.pending = []
+        self.snapshot = None # (số nước, chuỗi snapshot): mã hóa 1 lần, dùng chung cho mọi người xem
+
+    def add_move(self, mid, text):
+        self.moves.append(text); self.ids.append(mid)
+
+    def snapshot_text(self):
+        if self.snapshot is None or self.snapshot[0] != len(self.moves):
+            # Ghép thẳng các chuỗi nước đã mã hóa, không decode / encode lại từng nước
+            self.snapshot = (len(self.moves), '{"type": "snapshot", "game_id": %s, "moves": [%s]}'
+                             % (json.dumps(self.game_id), ", ".join(self.moves)))
+        return self.snapshot[1]
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
-        # Hàng chờ riêng cho từng loại bàn cờ
-        self.queues = {9: [], 13: [], 19: []}
-        # Lưu trận đấu đang diễn ra: {game_id: [ws_player1, ws_player2]}
+    """
+    Sổ socket / trận online của worker này, mọi thao tác thêm-bớt O(1).
+    Gửi không bao giờ await socket của người khác: tin được mã hóa JSON 1 lần rồi xếp vào hàng đợi từng socket.
+    Ghép trận và chuyển nước đi qua backend pub/sub nên 2 người ở 2 worker (2 máy) vẫn gặp nhau được:
+    worker đang giữ quyền leader chạy Matchmaker, báo "start" về kênh worker của từng người chơi.
+    """
+
+    def __init__(self, queue_max=SEND_QUEUE_MAX, policy=OVERFLOW_POLICY, backend=None):
+        self.queue_max = queue_max
+        self.policy = policy
+        self.backend = backend or create_backend()
+        self.clients: dict[WebSocket, Client] = {}
+        self.by_id: dict[str, WebSocket] = {}
+        self.next_id = 0
+        self.next_mid = 0 # Đếm nước đi gửi từ worker này (id nước = "<worker>:<số>")
+        # Hàng chờ riêng cho từng loại bàn cờ, ghép theo Elo (app/matchmaking.py) - chỉ dùng khi là leader
+        self.matchmaker = Matchmaker(BOARD_SIZES, self._on_match)
+        # Trận đang diễn ra có người chơi / người xem ở worker này: {game_id: GameChannel}
         self.active_games = {}
+        self.stats = {"sent": 0, "dropped": 0, "closed_slow": 0, "send_errors": 0, "games_started": 0,
+                      "games_abandoned": 0, "resyncs": 0, "coalesced": 0, "watchers_dropped": 0}
+
+    async def start(self):
+        await self.backend.start(self._on_message, (ALL_CHANNEL, f"w:{WORKER_ID}"), self._on_leader, self._resync)
+
+    async def stop(self):
+        await self.backend.stop()
+
+    @property
+    def active_connections(self):
+        return self.clients.keys()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.next_id += 1
+        client = Client(websocket, f"{WORKER_ID}:{self.next_id}")
+        self.clients[websocket] = client; self.by_id[client.cid] = websocket
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        client = self.clients.pop(websocket, None)
+        if client is None: return
+        del self.by_id[client.cid]
+        client.closed = True; client.outbox.clear()
         # Xóa khỏi hàng chờ nếu đang đợi
-        for size in self.queues:
-            if websocket in self.queues[size]:
-                self.queues[size].remove(websocket)
-
-    async def add_to_queue(self, websocket: WebSocket, size: int, user_info: dict):
-        # Kiểm tra hàng chờ của size này có ai không
-        if self.queues[size]:
-            opponent_ws = self.queues[size].pop(0)
-            game_id = f"online_{id(websocket)}"
-            
-            self.active_games[game_id] = [opponent_ws, websocket]
-            
-            # Opponent (người đợi trước) đi trước (Đen - 1)
-            # Người mới vào đi sau (Trắng - 2)
-            await opponent_ws.send_json({"type": "start", "game_id": game_id, "color": 1, "opponent": user_info})
-            await websocket.send_json({"type": "start", "game_id": game_id, "color": 2, "opponent": "waiting_player"})
+        if client.waiting is not None: self._publish(MM_CHANNEL, {"op": "cancel", "id": client.cid})
+        self._leave_game(websocket, client)
+        self._unwatch(websocket, client)
+
+    def _leave_game(self, websocket: WebSocket, client: Client):
+        """Bỏ trận đang đánh dở (ngắt kết nối / vào trận mới), báo đối thủ qua kênh trận."""
+        game_id = client.game_id
+        if game_id is None: return
+        client.game_id = None
+        self._untrack(game_id, websocket)
+        self.stats["games_abandoned"] += 1
+        self._publish(f"g:{game_id}", {"op": "left", "from": client.cid})
+
+    def _untrack(self, game_id, websocket):
+        ch = self.active_games.get(game_id)
+        if ch is None: return
+        ch.players.discard(websocket)
+        self._release(ch)
+
+    def _channel(self, game_id, ready):
+        ch = self.active_games.get(game_id)
+        if ch is None:
+            ch = self.active_games[game_id] = GameChannel(game_id, ready)
+            self.backend.subscribe(f"g:{game_id}")
+        return ch
+
+    def _release(self, ch):
+        """Worker không còn ai chơi / xem trận này thì thôi nghe kênh."""
+        if ch.players or ch.watchers or self.active_games.get(ch.game_id) is not ch: return
+        del self.active_games[ch.game_id]; self.backend.unsubscribe(f"g:{ch.game_id}")
+
+    def _publish(self, channel, message):
+        self.backend.publish(channel, json.dumps(message))
+
+    # --- GỬI ---
+    def send(self, websocket: WebSocket, message):
+        """Xếp 1 tin (dict hoặc chuỗi JSON đã mã hóa) vào hàng đợi gửi của socket."""
+        self.send_encoded(websocket, message if isinstance(message, str) else json.dumps(message))
+
+    def send_encoded(self, websocket: WebSocket, text: str):
+        client = self.clients.get(websocket)
+        if client is None or client.closed: return
+        if len(client.outbox) >= self.queue_max:
+            if client.watching is not None and client.game_id is None:
+                self._coalesce(client); return
+            if self.policy == "drop_oldest":
+                client.outbox.popleft(); self.stats["dropped"] += 1
+            else:
+                self.stats["closed_slow"] += 1
+                self._close(client, 1013); return
+        client.outbox.append(text)
+        if client.writer is None: client.writer = asyncio.create_task(self._write(client))
+
+    def broadcast(self, sockets, message, exclude=None):
+        """Gửi cùng 1 tin cho nhiều socket: mã hóa JSON 1 lần."""
+        text = json.dumps(message)
+        for ws in sockets:
+            if ws is not exclude: self.send_encoded(ws, text)
+
+    async def _write(self, client: Client):
+        try:
+            while client.outbox:
+                text = client.outbox.popleft()
+                await asyncio.wait_for(client.ws.send_text(text), SEND_TIMEOUT)
+                self.stats["sent"] += 1
+        except Exception:
+            self.stats["send_errors"] += 1
+            self._close(client, 1011)
+        finally:
+            client.writer = None
+
+    def _close(self, client: Client, code: int):
+        """Đóng socket không theo kịp; vòng nhận ở main sẽ gặp WebSocketDisconnect và gọi disconnect()."""
+        if client.closed: return
+        client.closed = True; client.outbox.clear()
+        if client.writer is not None and client.writer is not asyncio.current_task(): client.writer.cancel()
+        asyncio.create_task(self._close_ws(client.ws, code))
+
+    @staticmethod
+    async def _close_ws(ws: WebSocket, code: int):
+        try: await ws.close(code)
+        except Exception: pass
+
+    # --- GHÉP TRẬN ---
+    async def add_to_queue(self, websocket: WebSocket, size: int, user_info: dict, elo: int = 1000):
+        """Gửi phiếu xếp hàng cho leader; tick ghép trận (Matchmaker.run) sẽ báo "start" khi tìm được đối thủ hợp Elo."""
+        client = self.clients.get(websocket)
+        if client is None or client.closed: return
+        if size not in BOARD_SIZES:
+            self.send(websocket, {"type": "error", "message": f"Không hỗ trợ bàn {size}x{size}"}); return
+        client.waiting = {"op": "enqueue", "id": client.cid, "size": size, "elo": elo, "user": user_info, "since": time.time()}
+        self._publish(MM_CHANNEL, client.waiting)
+        self.send(websocket, {"type": "waiting", "message": f"Đang tìm đối thủ bàn {size}x{size}..."})
+
+    def _on_leader(self, is_leader):
+        if is_leader:
+            # Leader mới có hàng chờ rỗng: nhờ mọi worker gửi lại phiếu của người đang chờ
+            self.backend.subscribe(MM_CHANNEL)
+            self._publish(ALL_CHANNEL, {"op": "resync"})
         else:
-            self.queues[size].append(websocket)
-            await websocket.send_json({"type": "waiting", "message": f"Đang tìm đối thủ bàn {size}x{size}..."})
+            self.backend.unsubscribe(MM_CHANNEL)
+            self.matchmaker.clear() # Không thay object: main.py đang chạy self.matchmaker.run()
+
+    def _resync(self):
+        """Gửi lại phiếu xếp hàng của người đang chờ ở worker này (leader đổi / vừa nối lại backend)."""
+        self.stats["resyncs"] += 1
+        for client in self.clients.values():
+            if client.waiting is not None: self._publish(MM_CHANNEL, client.waiting)
+
+    def _on_match(self, black, white):
+        """Leader: người đợi trước đi trước (Đen - 1), người mới vào đi sau (Trắng - 2)."""
+        game_id = f"online_{uuid.uuid4().hex}"
+        self.stats["games_started"] += 1
+        for t, color, other in ((black, 1, white), (white, 2, black)):
+            self._publish(f"w:{t.key.split(':')[0]}", {"op": "start", "id": t.key, "game_id": game_id, "color": color,
+                                                        "opponent": other.user_info, "opponent_id": other.key})
+
+    def _start_local(self, msg):
+        game_id = msg["game_id"]
+        ws = self.by_id.get(msg["id"])
+        client = self.clients.get(ws) if ws is not None else None
+        if client is None or client.closed:
+            # Người này đã rời đi trước khi được ghép: báo thẳng về worker của đối thủ (kênh trận có thể chưa ai nghe)
+            self._publish(f"w:{msg['opponent_id'].split(':')[0]}", {"op": "left", "id": msg["opponent_id"], "game_id": game_id})
+            return
+        client.waiting = None
+        self._leave_game(ws, client)
+        client.game_id = game_id
+        ch = self._channel(game_id, ready=True)
+        ch.ready = True; ch.players.add(ws)
+        self.send(ws, {"type": "start", "game_id": game_id, "color": msg["color"], "opponent": msg["opponent"]})
+
+    def _opponent_left(self, ws, game_id):
+        client = self.clients.get(ws)
+        if client is None or client.game_id != game_id: return
+        client.game_id = None
+        self._untrack(game_id, ws)
+        self.send(ws, {"type": "opponent_left", "game_id": game_id})
+
+    # --- NHẬN TIN TỪ BACKEND ---
+    def _on_message(self, channel, text):
+        msg = json.loads(text)
+        op = msg["op"]
+        if channel.startswith("g:"):
+            ch = self.active_games.get(channel[2:])
+            if ch is None: return
+            if op == "move": self._on_move(ch, msg)
+            elif op == "left":
+                for ws in list(ch.players):
+                    if self.clients[ws].cid != msg["from"]: self._opponent_left(ws, ch.game_id)
+                self._fan_out(ch.watchers, json.dumps({"type": "player_left", "game_id": ch.game_id}))
+            elif op == "snap_req" and ch.ready and ch.players:
+                # Chỉ worker có người chơi trả lời (nhật ký chắc chắn đủ từ nước đầu)
+                self._publish(f"w:{msg['worker']}", {"op": "snapshot", "game_id": ch.game_id, "moves": ch.moves, "ids": ch.ids})
+        elif channel == MM_CHANNEL:
+            if op == "enqueue": self.matchmaker.enqueue(msg["id"], msg["size"], msg["elo"], msg["user"], msg["since"])
+            elif op == "cancel": self.matchmaker.cancel(msg["id"])
+        elif channel == ALL_CHANNEL:
+            if op == "resync": self._resync()
+        elif op == "start": self._start_local(msg)
+        elif op == "snapshot": self._on_snapshot(msg)
+        elif op == "left":
+            ws = self.by_id.get(msg["id"])
+            if ws is not None: self._opponent_left(ws, msg["game_id"])
 
     async def broadcast_move(self, game_id: str, move_data: dict, sender_ws: WebSocket):
-        if game_id in self.active_games:
-            for ws in self.active_games[game_id]:
-                if ws != sender_ws:
-                    await ws.send_json(move_data)
+        client = self.clients.get(sender_ws)
+        if client is None or client.game_id != game_id: return
+        self.next_mid += 1
+        self._publish(f"g:{game_id}", {"op": "move", "from": client.cid, "id": f"{WORKER_ID}:{self.next_mid}", "msg": json.dumps(move_data)})
+
+    def _on_move(self, ch, msg):
+        text = msg["msg"]
+        if not ch.ready:
+            ch.pending.append((msg["id"], text)); return
+        ch.add_move(msg["id"], text)
+        # msg["msg"] đã là JSON: mỗi worker chỉ giải mã phong bì 1 lần rồi gửi nguyên chuỗi cho từng socket
+        for ws in ch.players:
+            if self.clients[ws].cid != msg["from"]: self.send_encoded(ws, text)
+        self._fan_out(ch.watchers, text)
+
+    def _fan_out(self, sockets, text):
+        for ws in list(sockets): self.send_encoded(ws, text)
+
+    # --- NGƯỜI XEM ---
+    def spectate(self, websocket: WebSocket, game_id: str):
+        """Xem trận online game_id: nhận snapshot (danh sách nước đã đi) rồi từng nước tiếp theo."""
+        client = self.clients.get(websocket)
+        if client is None or client.closed: return
+        self._unwatch(websocket, client)
+        is_new = game_id not in self.active_games
+        ch = self._channel(game_id, ready=False)
+        ch.watchers.add(websocket); client.watching = game_id
+        if ch.ready: self.send_encoded(websocket, ch.snapshot_text())
+        elif is_new:
+            self._publish(f"g:{game_id}", {"op": "snap_req", "worker": WORKER_ID})
+            asyncio.get_running_loop().call_later(SNAPSHOT_TIMEOUT, self._snapshot_timeout, ch)
+
+    def unspectate(self, websocket: WebSocket):
+        client = self.clients.get(websocket)
+        if client is not None: self._unwatch(websocket, client)
+
+    def _unwatch(self, websocket: WebSocket, client: Client):
+        game_id = client.watching
+        if game_id is None: return
+        client.watching = None
+        ch = self.active_games.get(game_id)
+        if ch is not None:
+            ch.watchers.discard(websocket); self._release(ch)
+
+    def _on_snapshot(self, msg):
+        ch = self.active_games.get(msg["game_id"])
+        if ch is None or ch.ready: return
+        ch.moves = list(msg["moves"]); ch.ids = list(msg["ids"]); ch.ready = True
+        # Nước đến sau khi subscribe mà snapshot đã có thì bỏ (snapshot và pending chồng lên nhau 1 đoạn)
+        known = set(ch.ids)
+        for mid, text in ch.pending:
+            if mid not in known: ch.add_move(mid, text)
+        ch.pending = []
+        self._fan_out(ch.watchers, ch.snapshot_text())
+
+    def _snapshot_timeout(self, ch):
+        if ch.ready or self.active_games.get(ch.game_id) is not ch: return
+        self._fan_out(ch.watchers, json.dumps({"type": "error", "message": "Không tìm thấy trận"}))
+        for ws in ch.watchers:
+            c = self.clients.get(ws)
+            if c is not None: c.watching = None
+        ch.watchers.clear(); self._release(ch)
+
+    def _coalesce(self, client: Client):
+        """
+        Người xem không theo kịp: bỏ cả hàng đợi, thay bằng 1 snapshot mới (gộp mọi nước đang chờ).
+        Người xem kẹt hẳn thì lần gửi đang dở quá SEND_TIMEOUT và bị đóng như mọi socket khác.
+        """
+        ch = self.active_games.get(client.watching)
+        if ch is None or not ch.ready:
+            self.stats["watchers_dropped"] += 1
+            self._close(client, 1013); return
+        client.outbox.clear(); client.outbox.append(ch.snapshot_text())
+        self.stats["coalesced"] += 1
+        if client.writer is None: client.writer = asyncio.create_task(self._write(client))
+
+    def snapshot_stats(self):
+        s = dict(self.stats)
+        s["connections"] = len(self.clients)
+        s["writers"] = sum(1 for c in self.clients.values() if c.writer is not None)
+        s["queued_messages"] = sum(len(c.outbox) for c in self.clients.values())
+        s["waiting"] = sum(1 for c in self.clients.values() if c.waiting is not None)
+        s["active_games"] = sum(1 for ch in self.active_games.values() if ch.players)
+        s["watchers"] = sum(len(ch.watchers) for ch in self.active_games.values())
+        s["realtime"] = self.backend.snapshot_stats()
+        return s
+
+    def matchmaking_stats(self):
+        """Chỉ leader có số liệu ghép trận."""
+        if not self.backend.is_leader: return {"leader": False, "worker": WORKER_ID}
+        return {"leader": True, "worker": WORKER_ID, **self.matchmaker.snapshot_stats()}
 
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager()
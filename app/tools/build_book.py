@@ -0,0 +1,77 @@
+"""
+Build sách khai cuộc offline cho AI HARD.
+
+    py -m app.tools.build_book --sizes 9 13 19 --plies 4 --branch 3 --time 3
+
+Duyệt theo tầng từ bàn trống: mỗi thế cờ cho engine HARD tìm (tắt sách), ghi nước tốt nhất;
+tầng sau gồm nước tốt nhất + (branch - 1) ứng viên tĩnh tốt nhất kế tiếp.
+Thế cờ trùng nhau qua 8 phép đối xứng chỉ tính 1 lần. Kết quả: app/data/book_<size>.bin.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app.game_logic.board import GoBoard
+from app.game_logic.ai import AIPlayer
+from app.game_logic.book import BOOK_DIR, book_path, canonical_key, canonical_move, write_book
+
+def replay(size, moves):
+    board = GoBoard(size)
+    for r, c in moves: board.make_move(r, c, board.current_turn)
+    return board
+
+def search_position(args):
+    """Chạy trong process con: trả về (khóa, ô khung chuẩn, độ sâu, các nước con)."""
+    size, moves, time_limit, branch = args
+    board = replay(size, moves)
+    player = board.current_turn
+    ai = AIPlayer(size, 'hard')
+    ai.use_book = False; ai.time_limit = time_limit
+    best = ai.get_best_move(board, player)
+    if best is None: return None
+    key, _ = canonical_key(board, player)
+    others = [m for m in ai.get_candidate_moves(board, player)
+              if m != best and board.is_legal_point(board.point(*m), player)]
+    children = [best] + others[:branch - 1]
+    return key, canonical_move(board, player, best), ai.last_depth, children
+
+def build(size, plies, branch, time_limit, workers):
+    entries = {}
+    frontier = [[]]
+    with ProcessPoolExecutor(workers) as pool:
+        for ply in range(plies):
+            # Bỏ thế cờ đối xứng với thế đã có trong tầng này / tầng trước
+            jobs = []; seen = set()
+            for moves in frontier:
+                board = replay(size, moves)
+                key, _ = canonical_key(board, board.current_turn)
+                if key in entries or key in seen: continue
+                seen.add(key); jobs.append(moves)
+            start = time.time()
+            frontier = []
+            for moves, res in zip(jobs, pool.map(search_position, [(size, m, time_limit, branch) for m in jobs])):
+                if res is None: continue
+                key, move, depth, children = res
+                entries[key] = (move, depth)
+                frontier.extend(moves + [tuple(c)] for c in children)
+            print(f"[{size}x{size}] ply {ply + 1}: {len(jobs)} thế cờ, {time.time() - start:.1f}s, sách {len(entries)} mục")
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description="Build sách khai cuộc cho AI HARD")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[9, 13, 19])
+    parser.add_argument("--plies", type=int, default=4, help="Số nước đầu có trong sách")
+    parser.add_argument("--branch", type=int, default=3, help="Số nhánh mở ra ở mỗi thế cờ")
+    parser.add_argument("--time", type=float, default=3.0, help="Giây tìm cho mỗi thế cờ")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    os.makedirs(BOOK_DIR, exist_ok=True)
+    for size in args.sizes:
+        entries = build(size, args.plies, args.branch, args.time, args.workers)
+        write_book(book_path(size), size, entries)
+        print(f"Đã ghi {book_path(size)} ({len(entries)} mục)")
+
+if __name__ == "__main__":
+    main()
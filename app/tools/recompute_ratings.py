@@ -0,0 +1,79 @@
+"""
+Tính lại elo / wins / losses / current_streak của mọi user từ bảng matches (vd: sau khi đổi luật calculate_elo_change).
+
+    py -m app.tools.recompute_ratings --dry-run
+    py -m app.tools.recompute_ratings
+
+Duyệt matches theo id (= thứ tự thời gian) bằng con trỏ stream, mỗi trận gọi ranking_logic.apply_result trên
+trạng thái trong RAM của người chơi; trận online lấy Elo đối thủ từ trạng thái đã tính lại của đối thủ.
+Đọc / ghi thẳng qua con trỏ DBAPI (executemany với tuple, không ORM / Row từng dòng), trong 1 transaction. Mọi user bắt đầu từ START_ELO, nên user
+có trận từ trước khi có bảng matches cũng bị đưa về theo lịch sử đã ghi: chạy --dry-run xem trước.
+Server đang chạy tự thấy Elo mới sau chu kỳ nạp lại bảng xếp hạng (COVAY_LEADERBOARD_REFRESH).
+"""
+import argparse
+import time
+
+from sqlalchemy import select
+
+from app.models_db import engine, create_tables, User
+from app.ranking_logic import apply_result
+
+START_ELO = 1000 # Như lúc đăng ký
+CHUNK = 50000
+PLACEHOLDERS = {"qmark": "?", "format": "%s", "pyformat": "%s"} # Theo paramstyle của driver (sqlite3, psycopg...)
+
+def replay(conn, rewrite_matches=True):
+    """Trả về ({user_id: [elo, streak, wins, losses]}, [dòng matches cần ghi lại], số trận)."""
+    state = {uid: [START_ELO, 0, 0, 0] for (uid,) in conn.execute(select(User.id))}
+    match_rows = []; n = 0
+    cur = conn.connection.cursor()
+    cur.execute("SELECT id, user_id, opponent_id, difficulty, is_win, opponent_elo FROM matches ORDER BY id")
+    add = match_rows.append
+    while rows := cur.fetchmany(CHUNK):
+        for mid, uid, opp_id, difficulty, is_win, opp_elo in rows:
+            st = state.get(uid)
+            if st is None: continue # User đã bị xóa
+            if opp_id is not None and opp_id in state: opp_elo = state[opp_id][0]
+            before = st[0]
+            st[0], st[1], delta = apply_result(before, st[1], is_win, difficulty, opp_elo)
+            if is_win: st[2] += 1
+            else: st[3] += 1
+            if rewrite_matches: add((opp_elo, before, st[0], delta, mid))
+        n += len(rows)
+    cur.close()
+    return state, match_rows, n
+
+def write(conn, state, match_rows):
+    p = PLACEHOLDERS[conn.dialect.paramstyle]
+    cur = conn.connection.cursor()
+    cur.executemany(f"UPDATE users SET elo = {p}, current_streak = {p}, wins = {p}, losses = {p} WHERE id = {p}",
+                    [(e, s, w, l, uid) for uid, (e, s, w, l) in state.items()])
+    sql = f"UPDATE matches SET opponent_elo = {p}, elo_before = {p}, elo_after = {p}, delta = {p} WHERE id = {p}"
+    for i in range(0, len(match_rows), CHUNK):
+        cur.executemany(sql, match_rows[i:i + CHUNK])
+    cur.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Tính lại Elo toàn bộ user từ lịch sử trận")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ in thay đổi, không ghi DB")
+    parser.add_argument("--skip-matches", action="store_true", help="Không ghi lại elo_before / elo_after / delta của từng trận")
+    args = parser.parse_args()
+
+    create_tables()
+    start = time.time()
+    with engine.connect() as conn:
+        state, match_rows, n = replay(conn, not args.skip_matches and not args.dry_run)
+        print(f"Đã duyệt {n} trận, {len(state)} user trong {time.time() - start:.1f}s")
+        current = {uid: (elo, streak, w, l) for uid, elo, streak, w, l in
+                   conn.execute(select(User.id, User.elo, User.current_streak, User.wins, User.losses))}
+        changed = [(uid, current[uid][0], st[0]) for uid, st in state.items() if tuple(st) != current[uid]]
+        print(f"{len(changed)} user thay đổi")
+        for uid, old, new in sorted(changed, key=lambda c: -abs(c[2] - c[1]))[:10]:
+            print(f"  user {uid}: elo {old} -> {new}")
+        if args.dry_run: return
+        write(conn, state, match_rows)
+        conn.commit()
+    print(f"Đã ghi xong trong {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
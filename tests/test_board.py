@@ -0,0 +1,31 @@
+import random
+
+from app.game_logic.board import GoBoard, BLACK, WHITE
+
+def chains(board):
+    """{ô: (tập quân, tập khí)} của chuỗi chứa ô đó, theo bản ghi tăng dần của board."""
+    out = {}
+    for p in board.tables.points:
+        if board.board[p] in (BLACK, WHITE):
+            h = board.chain_head[p]
+            out[p] = (frozenset(board.chain_stones[h]), frozenset(board.chain_libs[h]))
+    return out
+
+def assert_consistent(board):
+    fresh = board.copy(); fresh._rebuild_chains()
+    assert chains(board) == chains(fresh)
+
+def play_random(board, rng, n):
+    for _ in range(n):
+        if board.is_game_over: return
+        r, c = rng.randrange(board.size), rng.randrange(board.size)
+        board.make_move(r, c, board.current_turn)
+
+def test_undo_on_copied_board_keeps_chains_separate():
+    for trial in range(300):
+        rng = random.Random(trial)
+        b = GoBoard(9); play_random(b, rng, 60)
+        c = b.copy()
+        c.undo_round(); b.undo_round()
+        play_random(b, rng, 20); play_random(c, rng, 20)
+        assert_consistent(b); assert_consistent(c)